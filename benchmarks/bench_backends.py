@@ -0,0 +1,78 @@
+# Compares the per-song overhead of the subprocess and embedded youtube_dl backends
+# Both run the same fake extractor, which serves a small file from a local web server, so only the backend differs
+# Requires the youtube_dl package. Usage: python benchmarks/bench_backends.py [songs]
+import os, sys, tempfile, threading, time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import logging
+logging.disable(logging.INFO)
+
+# Shared by this process and the fake youtube-dl executable
+FAKE_EXTRACTOR = """
+import os, sys
+from youtube_dl.extractor.common import InfoExtractor
+
+class FakeIE(InfoExtractor):
+  _VALID_URL = r"(?P<id>fake\\d+)"
+  def _real_extract(self, url):
+    id = self._match_id(url)
+    return {"id": id, "title": "Fake Song " + id, "url": os.environ["FAKE_MEDIA_URL"], "ext": "mp3",
+            "uploader": "Nobody", "duration": 1, "alt_title": None, "artist": None, "album": None}
+
+def install():
+  import youtube_dl.extractor
+  youtube_dl.extractor.FakeIE = FakeIE # So it can be found by name
+  sys.modules["youtube_dl.YoutubeDL"].gen_extractor_classes = lambda: [FakeIE]
+"""
+
+FAKE_EXECUTABLE = FAKE_EXTRACTOR + """
+install()
+import youtube_dl
+youtube_dl.main(sys.argv[1:])
+"""
+
+def serve(folder):
+  """ Serves the folder over http on a free port, returning the server """
+  handler = lambda *args: SimpleHTTPRequestHandler(*args, directory=folder)
+  SimpleHTTPRequestHandler.log_message = lambda *args: None
+  server = HTTPServer(("127.0.0.1", 0), handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def main(count):
+  with tempfile.TemporaryDirectory() as folder:
+    with open(os.path.join(folder, "media.mp3"), "wb") as file:
+      file.write(os.urandom(64*1024))
+    with open(os.path.join(folder, "fake_youtube_dl.py"), "w") as file:
+      file.write(FAKE_EXECUTABLE)
+    server = serve(folder)
+    os.environ["FAKE_MEDIA_URL"] = "http://127.0.0.1:{}/media.mp3".format(server.server_port)
+
+    namespace = {}
+    exec(FAKE_EXTRACTOR, namespace)
+    namespace["install"]()
+
+    import DownloadHandler
+    DownloadHandler.settings["youtube_dl"] = [sys.executable, os.path.join(folder, "fake_youtube_dl.py")]
+    options = {"--write-info-json": True} # No -x, so ffmpeg isn't needed and only the backend overhead is measured
+    print("{:<12} {:>16} {:>16}".format("backend", "getInfo (ms)", "download (ms)"))
+    for name, backend in DownloadHandler.backends.items():
+      backend = backend()
+      output = os.path.join(folder, name)
+      start = time.perf_counter()
+      for i in range(count):
+        info = backend.getInfo("fake{}".format(i), playlist=False)
+        assert isinstance(info, dict), info
+      infoTime = time.perf_counter() - start
+      start = time.perf_counter()
+      for i in range(count):
+        code, text = backend.download("fake{}".format(i), options, os.path.join(output, "%(id)s.%(ext)s"))
+        assert code == 0, text
+      downloadTime = time.perf_counter() - start
+      print("{:<12} {:>16.1f} {:>16.1f}".format(name, 1000*infoTime/count, 1000*downloadTime/count))
+    server.shutdown()
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,63 @@
+# Compares exporting songs by copying then retagging against FileHandler's single-pass copy and tag
+# Bytes written are read from /proc/self/io, so are only reported on Linux
+# Requires mutagen. Usage: python benchmarks/bench_copysong.py [songs] [KiB per song]
+import os, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+from mutagen.id3 import ID3, TSSE
+
+def bytesWritten():
+  try:
+    with open("/proc/self/io") as file:
+      for line in file:
+        if line.startswith("wchar:"):
+          return int(line.split()[1])
+  except FileNotFoundError:
+    return None
+
+def makeSource(path, size):
+  """ Like ffmpeg's output: a small tag with no padding, so adding our tags makes it grow """
+  with open(path, "wb"):
+    pass
+  tag = ID3()
+  tag.add(TSSE(encoding=3, text=["Lavf58.29.100"]))
+  tag.save(path, padding=lambda info: 0)
+  with open(path, "ab") as file:
+    file.write(os.urandom(size))
+
+def twoPass(id, folder, filename, **tags):
+  """ The original copySong """
+  import DatabaseHandler, FileHandler
+  src = DatabaseHandler.getVideoFolder(id)
+  dest = os.path.join(folder, filename+".mp3")
+  os.makedirs(folder, exist_ok=True)
+  shutil.copyfile(src, dest)
+  FileHandler.changeTags(dest, tags)
+
+def main(count, size):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DatabaseHandler, FileHandler
+    os.makedirs(DatabaseHandler.getVideoFolder())
+    for i in range(count):
+      makeSource(DatabaseHandler.getVideoFolder("song{}".format(i)), size*1024)
+    tags = {"title": "Some Song Title", "artist": "Some Artist", "album": "Some Album"}
+
+    print("{:<12} {:>12} {:>18}".format("method", "time (s)", "MiB written"))
+    for name, function in (("copy+retag", twoPass), ("single pass", FileHandler.copySong)):
+      before = bytesWritten()
+      start = time.perf_counter()
+      for i in range(count):
+        function("song{}".format(i), name, "Song {}".format(i), organization="PL/song{}".format(i), **tags)
+      elapsed = time.perf_counter() - start
+      written = "{:.1f}".format((bytesWritten() - before) / 2**20) if before is not None else "n/a"
+      print("{:<12} {:>12.3f} {:>18}".format(name, elapsed, written))
+      shutil.rmtree(name)
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 1000, int(args[1]) if len(args) > 1 else 512)
@@ -0,0 +1,50 @@
+# Compares the cost of saving and loading the song database with each storage backend
+# Usage: python benchmarks/bench_database.py [sizes...]
+import os, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import SongStore
+
+def makeSong(i):
+  return {
+    "downloadedAt": 1500000000 + i,
+    "title": "Some Artist {} - Some Song Title (Official Video)".format(i),
+    "author": "Uploader {}".format(i % 300),
+    "length": 180 + i % 120,
+    "songTitle": None,
+    "songArtist": None,
+    "songAlbum": None,
+  }
+
+def timeIt(func):
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+def bench(store, size):
+  """ Returns (initial save, save after one song changed, full load) times in seconds """
+  videos = {"id{:07d}".format(i): makeSong(i) for i in range(size)}
+  def initial():
+    for id, song in videos.items():
+      store.put(id, song)
+    store.flush()
+  def oneChange():
+    videos["id0000000"]["downloadedAt"] += 1
+    store.put("id0000000", videos["id0000000"])
+    store.flush()
+  return timeIt(initial), timeIt(oneChange), timeIt(store.load)
+
+def main(sizes):
+  print("{:>8} {:>8} {:>12} {:>12} {:>12}".format("backend", "songs", "first save", "save 1 song", "load"))
+  for size in sizes:
+    with tempfile.TemporaryDirectory() as folder:
+      for name, store in (
+        ("json", SongStore.JSONStore(os.path.join(folder, "data.json"))),
+        ("sqlite", SongStore.SQLiteStore(os.path.join(folder, "data.db"), batchSize=size+1)),
+      ):
+        results = bench(store, size)
+        store.close()
+        print("{:>8} {:>8} {:>11.4f}s {:>11.4f}s {:>11.4f}s".format(name, size, *results))
+
+if __name__ == "__main__":
+  main([int(i) for i in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,41 @@
+# Times MusicSet.getDownloadSet against a stubbed getInfo returning many large playlists
+# Usage: python benchmarks/bench_downloadset.py [playlists] [songs per playlist] [seconds of latency per getInfo]
+import os, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+def main(playlists, songs, latency):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DatabaseHandler, DownloadHandler, FileHandler, StructureHandler
+    DownloadHandler.settings["infoCacheTTL"] = 0 # Always "fetch", so the stub's latency counts
+    DownloadHandler.settings["metadataRate"] = 0
+
+    def getInfo(url, playlist=True):
+      time.sleep(latency) # Pretend to wait on youtube
+      return {"_type": "playlist", "id": url, "entries": [
+        {"_type": "url", "id": "{}-{}".format(url, i), "title": "Artist {} - Song {}".format(i % 97, i)} for i in range(songs)
+      ]}
+    handler = DownloadHandler.getHandler()
+    handler.backend.getInfo = getInfo
+    FileHandler.copySong = lambda *args, **kwargs: None # Only time the planning, not the file copying
+
+    musicSet = StructureHandler.MusicSet()
+    musicSet.initialize({"name": "bench", "sources": [{"id": "PL{}".format(i), "title": "", "folder": "PL{}".format(i)} for i in range(playlists)], "songs": []})
+    musicSet.rules.append(StructureHandler.ArtistTitleRule(False))
+    for i in range(playlists): # Every tenth song is already downloaded, so it has to be placed in the set
+      for j in range(0, songs, 10):
+        DatabaseHandler.setDownloaded("PL{}-{}".format(i, j))
+
+    for run in ("first sync", "second sync"):
+      start = time.perf_counter()
+      toDownload = musicSet.getDownloadSet()
+      print("{:<12} {:.3f}s  ({} to download, {} songs in set)".format(run, time.perf_counter() - start, len(toDownload), len(musicSet.songsExpected)))
+    DatabaseHandler._store.close()
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 50, int(args[1]) if len(args) > 1 else 500, float(args[2]) if len(args) > 2 else 0.2)
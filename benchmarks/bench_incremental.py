@@ -0,0 +1,56 @@
+# Compares re-running every song's rules against only re-evaluating the songs affected by a change
+# Usage: python benchmarks/bench_incremental.py [songs] [playlists]
+import os, random, sys, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+from bench_rules import makeTitle, timed
+
+def main(count, playlists):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DatabaseHandler, StructureHandler
+    rand = random.Random(1)
+    sources = [{"id": "PL{}".format(i), "title": "", "folder": "PL{}".format(i)} for i in range(playlists)]
+    entries = [{"_type": "url", "id": "song{}".format(i), "title": makeTitle(rand)} for i in range(count)]
+    DatabaseHandler.addSongFromDict({"_type": "playlist", "entries": entries})
+
+    musicSet = StructureHandler.MusicSet()
+    musicSet.initialize({"name": "bench", "sources": sources, "songs": [
+      {"id": entry["id"], "playlist": "PL{}".format(i % playlists), "settings": {}} for i, entry in enumerate(entries)
+    ]})
+    musicSet.rules.append(StructureHandler.ArtistTitleRule(False))
+    for song in musicSet.songsExpected:
+      musicSet.runRules(song)
+
+    def changed():
+      count = len(musicSet.changeSet)
+      musicSet.changeSet.clear()
+      return count
+
+    print("{} songs in {} playlists".format(count, playlists))
+    print("  {:<44} {:>8.3f}s  {:>6} changes".format("runRulesAllSongs, nothing changed", timed(musicSet.runRulesAllSongs), changed()))
+    playlist = musicSet.sources["PL0"]
+    print("  {:<44} {:>8.3f}s  {:>6} changes".format("change one playlist's folder", timed(lambda: playlist.setFolder("Renamed")), changed()))
+    print("  {:<44} {:>8.3f}s  {:>6} changes".format("add a rule to one playlist", timed(lambda: musicSet.addRule(StructureHandler.ArtistTitleRule(False), "PL1")), changed()))
+    for i in rand.sample(range(count), 100):
+      DatabaseHandler.addSongFromDict({"_type": "url", "id": "song{}".format(i), "title": makeTitle(rand)})
+    for i in rand.sample(range(count), 1000): # Touched, but nothing the rules read changed
+      DatabaseHandler.setDownloaded("song{}".format(i))
+    print("  {:<44} {:>8.3f}s  {:>6} changes".format("refresh after 100 titles and 1000 downloads", timed(musicSet.refresh), changed()))
+
+    # A saved set only keeps what the user changed, so a loaded set runs its rules for the first time without moving anything
+    loaded = StructureHandler.MusicSet()
+    loaded.initialize(musicSet.save())
+    loaded.rules.append(StructureHandler.ArtistTitleRule(False))
+    print("  {:<44} {:>8.3f}s  {:>6} changes".format("save, load, runRulesAllSongs", timed(loaded.runRulesAllSongs), len(loaded.changeSet)))
+    assert not loaded.changeSet
+    assert [song.settings.copy() for song in loaded.songsExpected] == [song.settings.copy() for song in musicSet.songsExpected]
+    DatabaseHandler._store.close()
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 30000, int(args[1]) if len(args) > 1 else 20)
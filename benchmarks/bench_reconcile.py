@@ -0,0 +1,39 @@
+# Times database initialization against a video folder full of synthetic song files
+# Usage: python benchmarks/bench_reconcile.py [number of files]
+import os, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO) # Don't time the logging
+
+def main(count):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    os.makedirs("_VideoStore")
+    for i in range(count):
+      open(os.path.join("_VideoStore", "id{:07d}.mp3".format(i)), "w").close()
+    # Backdate the folder so the manifest is trusted on the next start
+    past = time.time() - 60
+    os.utime("_VideoStore", (past, past))
+
+    import DatabaseHandler # Importing does nothing until initialize is called, or the database is first used
+    start = time.perf_counter()
+    DatabaseHandler.initialize(background=True) # As bootstrap starts it, reconciling in a background thread
+    started = time.perf_counter() - start
+    DatabaseHandler.isDownloaded("id0000000") # Waits for initialization to finish
+    cold = time.perf_counter() - start
+    DatabaseHandler.save()
+
+    start = time.perf_counter()
+    DatabaseHandler.initialize()
+    warm = time.perf_counter() - start
+
+    print("{} files".format(count))
+    print("  initialize returned     {:.4f}s".format(started))
+    print("  cold start (full scan)  {:.4f}s".format(cold))
+    print("  warm start (manifest)   {:.4f}s".format(warm))
+    DatabaseHandler._store.close()
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
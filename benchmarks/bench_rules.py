@@ -0,0 +1,81 @@
+# Times MusicSet.runRulesAllSongs over many songs with realistic youtube titles
+# Usage: python benchmarks/bench_rules.py [songs] [processes]
+import os, random, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+TITLES = (
+  "{artist} - {title}",
+  "{artist} - {title} (Official Video)",
+  "{artist} - {title} (Official Music Video)",
+  "{artist} | {title} [Lyrics]",
+  "{artist} - {title} (Lyrics)",
+  "{artist} - {title} (Official Audio)",
+  "{artist} -{title} with lyrics",
+  "\"{title}\" by {artist}",
+  "{title}",
+)
+
+def makeTitle(random):
+  artist = " ".join(random.choice(("The", "DJ", "Lil", "Young", "")) + random.choice(("Echo", "Velvet", "Nova", "Ghost", "Arctic", "Neon")) for i in range(random.randint(1, 2))).strip()
+  title = " ".join(random.choice(("Love", "Night", "Fire", "Dreams", "Run", "Away", "Heart", "City", "Lights", "Gone")) for i in range(random.randint(1, 4)))
+  return random.choice(TITLES).format(artist=artist, title=title)
+
+def forget(StructureHandler, musicSet):
+  """ Throws away every remembered rule result """
+  # Songs still refer to their pipeline, see Song.ruleKey. The set may use pipelines no longer shared, so both are cleared
+  for pipeline in list(StructureHandler.RulePipeline._pipelines.values()) + [cached[1] for cached in musicSet.pipelines.values()]:
+    pipeline.results.clear()
+  StructureHandler.RulePipeline._pipelines.clear()
+  musicSet.pipelines.clear()
+
+def timed(function):
+  start = time.perf_counter()
+  function()
+  return time.perf_counter() - start
+
+def main(count, processes):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DatabaseHandler, StructureHandler
+    rand = random.Random(1)
+    sources = [{"id": "PL{}".format(i), "title": "", "folder": "PL{}".format(i)} for i in range(20)]
+    entries = [{"_type": "url", "id": "song{}".format(i), "title": makeTitle(rand)} for i in range(count)]
+    DatabaseHandler.addSongFromDict({"_type": "playlist", "entries": entries})
+
+    musicSet = StructureHandler.MusicSet()
+    musicSet.initialize({"name": "bench", "sources": sources, "songs": [
+      {"id": entry["id"], "playlist": "PL{}".format(i % 20), "settings": {}} for i, entry in enumerate(entries)
+    ]})
+    musicSet.rules.append(StructureHandler.ArtistTitleRule(False))
+
+    infos = [DatabaseHandler.getSong(song.id) for song in musicSet.songsExpected]
+    def evaluate(processes=None):
+      return musicSet.getPipeline(None).evaluateMany(infos, processes)
+    def oneAtATime():
+      for song in musicSet.songsExpected:
+        musicSet.runRules(song, addToChangeSet=True)
+
+    for song in musicSet.songsExpected: # Songs have no filename until their rules first run, and a change needs one to move from
+      musicSet.runRules(song)
+
+    print("{} songs".format(count))
+    forget(StructureHandler, musicSet)
+    print("  evaluate rules, cold                {:.3f}s".format(timed(evaluate)))
+    print("  evaluate rules, warm                {:.3f}s".format(timed(evaluate)))
+    if processes:
+      forget(StructureHandler, musicSet)
+      print("  evaluate rules, cold, {} processes   {:.3f}s".format(processes, timed(lambda: evaluate(processes))))
+    forget(StructureHandler, musicSet)
+    print("  runRules one at a time, cold        {:.3f}s".format(timed(oneAtATime)))
+    forget(StructureHandler, musicSet)
+    print("  runRulesAllSongs, cold              {:.3f}s".format(timed(musicSet.runRulesAllSongs)))
+    print("  runRulesAllSongs, warm              {:.3f}s".format(timed(musicSet.runRulesAllSongs)))
+    DatabaseHandler._store.close()
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 50000, int(args[1]) if len(args) > 1 else 0)
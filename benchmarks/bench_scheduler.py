@@ -0,0 +1,57 @@
+# Simulates a big playlist backfilling while a small one is synced, a new playlist is added and the user asks for a song,
+#   with and without priorities and turn-taking between playlists
+# Downloads are replaced by a sleep, so this only measures the order songs are started in
+# Usage: python benchmarks/bench_scheduler.py [songs in big playlist] [seconds per download] [workers]
+import os, sys, tempfile, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+def simulate(DownloadHandler, bigSize, duration, scheduled):
+  """ Returns a dict of playlist to (seconds until its first song finished, seconds until all its songs finished), from when it was submitted """
+  processor = DownloadHandler.VideoProcessor()
+  processor.fetchSong = lambda songID, outputFunction=None: (time.sleep(duration), (True, ""))[1]
+  start = time.perf_counter()
+  finished = {}
+  submitted = {}
+  lock = threading.Lock()
+  def submit(playlist, count, priority):
+    futures = []
+    submitted[playlist] = time.perf_counter() - start
+    for i in range(count):
+      def complete(songID, success, playlist=playlist):
+        with lock:
+          finished.setdefault(playlist, []).append(time.perf_counter() - start)
+      options = {"playlist": playlist, "priority": priority} if scheduled else {"group": "all"} # Without priorities everything is one FIFO
+      futures.append(processor.submitSong("{}-{}".format(playlist, i), completeFunc=complete, **options))
+    return futures
+
+  futures = submit("big", bigSize, DownloadHandler.BACKFILL)
+  futures += submit("small", 20, DownloadHandler.BACKFILL)
+  futures += submit("new", 10, DownloadHandler.NEW_PLAYLIST)
+  futures += submit("clicked", 1, DownloadHandler.INTERACTIVE)
+  for future in futures:
+    future.result()
+  processor.executor.shutdown()
+  processor.jobs.close()
+  return {playlist: (min(times) - submitted[playlist], max(times) - submitted[playlist]) for playlist, times in finished.items()}
+
+def main(bigSize, duration, workers):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DownloadHandler
+    DownloadHandler.settings["concurrentDownloads"] = workers
+    DownloadHandler.settings["separateTranscode"] = False # Songs are "downloaded" by the stand-in for fetchSong in one step
+    print("{} workers, {:.0f}ms per song, {} songs backfilling".format(workers, duration*1000, bigSize))
+    print("{:<10} {:<10} {:>18} {:>18}".format("mode", "playlist", "first song (s)", "last song (s)"))
+    for mode, scheduled in (("fifo", False), ("priority", True)):
+      results = simulate(DownloadHandler, bigSize, duration, scheduled)
+      for playlist in ("clicked", "new", "small", "big"):
+        first, last = results[playlist]
+        print("{:<10} {:<10} {:>18.3f} {:>18.3f}".format(mode, playlist, first, last))
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 2000, float(args[1]) if len(args) > 1 else 0.01, int(args[2]) if len(args) > 2 else 8)
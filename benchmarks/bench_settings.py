@@ -0,0 +1,58 @@
+# Times lookups, iteration and copies of a song's layered settings, against the unflattened lookups SettingsDict used before
+# Usage: python benchmarks/bench_settings.py [repeats]
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import Settings
+
+class LayeredDict(dict):
+  """ How SettingsDict looked values up before it cached a flattened view, each missing key asks the next layer """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._defaults = {}
+  def __missing__(self, key):
+    return self._defaults[key]
+  def __iter__(self):
+    return iter(set(super().__iter__()) | set(self._defaults))
+  def __len__(self):
+    return len(set(self) | set(self._defaults))
+  def copy(self):
+    toRet = {}
+    for key in self:
+      toRet[key] = self[key]
+    return toRet
+  def createInstance(self):
+    toRet = self.__class__()
+    toRet._defaults = self
+    return toRet
+
+def songLayers(cls):
+  """ Builds the layers a song's settings have: module defaults, music set, playlist, rule results, overrides """
+  module = cls({"folder": "", "filename": None, "title": "Default Song", "artist": "DJ Dan", "album": None})
+  musicSet = module.createInstance()
+  playlist = musicSet.createInstance()
+  playlist["folder"] = "Playlist"
+  defaults = playlist.createInstance()
+  defaults.update({"filename": "Artist - Title", "title": "Title", "artist": "Artist"})
+  settings = defaults.createInstance()
+  settings["album"] = "Album"
+  return defaults, settings
+
+def main(repeats):
+  print("{} repeats, 5 layers".format(repeats))
+  print("{:<36} {:>12} {:>12}".format("", "before (s)", "after (s)"))
+  cases = (
+    ("lookup, own key", lambda defaults, settings: settings["album"]),
+    ("lookup, from the module defaults", lambda defaults, settings: settings["title"]),
+    ("iterate", lambda defaults, settings: list(settings)),
+    ("len", lambda defaults, settings: len(settings)),
+    ("copy", lambda defaults, settings: settings.copy()),
+    ("rule results change, then copy", lambda defaults, settings: (defaults.update(title="Title"), settings.copy())),
+  )
+  layers = {cls: songLayers(cls) for cls in (LayeredDict, Settings.SettingsDict)}
+  for name, case in cases:
+    times = [timeit.timeit(lambda: case(*layers[cls]), number=repeats) for cls in (LayeredDict, Settings.SettingsDict)]
+    print("{:<36} {:>12.3f} {:>12.3f}".format(name, *times))
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,47 @@
+# Measures the memory a MusicSet's songs take, with tracemalloc, once loaded from a save and once their rules have run
+# Usage: python benchmarks/bench_songmemory.py [songs...]
+import gc, os, random, sys, tempfile, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+from bench_rules import makeTitle, forget
+
+def measure(StructureHandler, saved):
+  """ Returns the bytes allocated by loading the saved set, and by then running its rules, which are kept alive until measured """
+  gc.collect()
+  tracemalloc.start()
+  start = tracemalloc.get_traced_memory()[0]
+  musicSet = StructureHandler.MusicSet()
+  musicSet.initialize(saved)
+  musicSet.rules.append(StructureHandler.ArtistTitleRule(False))
+  loaded = tracemalloc.get_traced_memory()[0] - start
+  for song in musicSet.songsExpected:
+    musicSet.runRules(song)
+  forget(StructureHandler, musicSet) # Remembered rule results aren't part of the songs
+  gc.collect()
+  ruled = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+  assert musicSet.save() == saved # The save format hasn't changed
+  return loaded, ruled
+
+def main(counts):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import DatabaseHandler, StructureHandler
+    rand = random.Random(1)
+    print("{:>8} {:>16} {:>16} {:>16}".format("songs", "loaded (MB)", "rules run (MB)", "bytes per song"))
+    for count in counts:
+      sources = [{"id": "PL{}".format(i), "title": "", "folder": "PL{}".format(i), "fingerprint": None} for i in range(20)]
+      entries = [{"_type": "url", "id": "song{}".format(i), "title": makeTitle(rand)} for i in range(count)]
+      DatabaseHandler.addSongFromDict({"_type": "playlist", "entries": entries})
+      songs = [{"id": entry["id"], "playlist": "PL{}".format(i % 20), "settings": {"album": "Favourites"} if i % 20 == 0 else {}}
+        for i, entry in enumerate(entries)] # A few songs have settings the user changed
+      loaded, ruled = measure(StructureHandler, {"name": "bench", "sources": sources, "songs": songs})
+      print("{:>8} {:>16.1f} {:>16.1f} {:>16.0f}".format(count, loaded / 2**20, ruled / 2**20, ruled / count))
+    DatabaseHandler._store.close()
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,59 @@
+# Reports the import cost of each of our modules, and the wall-clock time until the first window is drawn
+# Usage: python benchmarks/bench_startup.py
+import os, shutil, subprocess, sys, tempfile
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+MODULES = ("Settings", "SongStore", "DatabaseHandler", "DownloadHandler", "FileHandler", "StructureHandler", "mainDisplay")
+
+# Runs the real main() but stops the main loop once the first frame is drawn
+FIRST_WINDOW = """
+import time
+start = time.perf_counter()
+import tkinter
+def mainloop(self, n=0):
+  self.update()
+  print(time.perf_counter() - start)
+  self.destroy()
+tkinter.Tk.mainloop = mainloop
+import main
+main.main()
+"""
+
+def run(args, folder, **kwargs):
+  """ Runs python in a scratch folder, so the database and queue files made on start don't end up in src """
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (SRC, os.environ.get("PYTHONPATH")))))
+  return subprocess.run([sys.executable] + args, cwd=folder, env=env, universal_newlines=True, **kwargs)
+
+def importTimes(folder):
+  """ Returns a dict of module name to cumulative import time in microseconds, as reported by -X importtime """
+  code = "for module in {!r}:\n  try: __import__(module)\n  except ImportError: pass".format(MODULES)
+  output = run(["-X", "importtime", "-c", code], folder, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL).stderr
+  times = {}
+  for line in output.splitlines():
+    if line.startswith("import time:") and "|" in line:
+      selfTime, cumulative, name = line[len("import time:"):].split("|")
+      if cumulative.strip().isdigit():
+        times[name.strip()] = int(cumulative)
+  return times
+
+def main():
+  with tempfile.TemporaryDirectory() as folder:
+    shutil.copytree(os.path.join(SRC, "img"), os.path.join(folder, "img")) # The window loads its images relative to the working folder
+    report(folder)
+
+def report(folder):
+  times = importTimes(folder)
+  print("{:<20} {:>12}".format("module", "import (ms)"))
+  for module in MODULES:
+    if module in times:
+      print("{:<20} {:>12.1f}".format(module, times[module]/1000))
+    else:
+      print("{:<20} {:>12}".format(module, "failed"))
+  result = run(["-c", FIRST_WINDOW], folder, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  if result.returncode == 0:
+    print("Time to first window: {:.3f}s".format(float(result.stdout.strip().splitlines()[-1])))
+  else:
+    print("Time to first window: could not open a window (no display?)")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,52 @@
+# Times MusicSet.initialize reading the tags of a folder of songs, with and without the sidecar tag index
+# Requires mutagen. Usage: python benchmarks/bench_tagindex.py [songs] [percent changed]
+import os, random, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, TPUB
+
+def makeSong(path, i, title="Song"):
+  with open(path, "wb"):
+    pass
+  tag = ID3()
+  tag.add(TIT2(encoding=3, text=["{} {}".format(title, i)]))
+  tag.add(TPE1(encoding=3, text=["Artist {}".format(i % 97)]))
+  tag.add(TALB(encoding=3, text=["Album {}".format(i % 13)]))
+  tag.add(TPUB(encoding=3, text=["PL{}/song{}".format(i % 20, i)]))
+  tag.save(path, v2_version=3)
+  with open(path, "ab") as file:
+    file.write(b"\xff\xfb" + bytes(2046)) # A stand-in for the audio
+
+def main(count, percent):
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    import StructureHandler
+    paths = []
+    for i in range(count):
+      subFolder = os.path.join("bench", "PL{}".format(i % 20))
+      os.makedirs(subFolder, exist_ok=True)
+      paths.append(os.path.join(subFolder, "Song {}.mp3".format(i)))
+      makeSong(paths[-1], i)
+
+    def load():
+      start = time.perf_counter()
+      musicSet = StructureHandler.MusicSet()
+      musicSet.initialize({"name": "bench", "sources": [], "songs": []})
+      assert len(musicSet.songsActual) == count
+      return time.perf_counter() - start
+
+    print("{} songs".format(count))
+    print("  cold (no index)       {:.3f}s".format(load()))
+    print("  warm                  {:.3f}s".format(load()))
+    changed = random.sample(range(count), max(1, count * percent // 100))
+    for i in changed:
+      makeSong(paths[i], i, "Renamed")
+    print("  warm, {} changed    {:.3f}s".format(len(changed), load()))
+    os.chdir(os.path.dirname(folder))
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  main(int(args[0]) if args else 20000, int(args[1]) if len(args) > 1 else 1)
@@ -0,0 +1,32 @@
+# Compares reading song tags one at a time with mutagen against FileHandler.getTagDataMany
+# Requires mutagen. Usage: python benchmarks/bench_tagreader.py [songs]
+import os, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.INFO)
+
+from bench_tagindex import makeSong
+
+def main(count):
+  with tempfile.TemporaryDirectory() as folder:
+    import FileHandler
+    paths = [os.path.join(folder, "Song {}.mp3".format(i)) for i in range(count)]
+    for i, path in enumerate(paths):
+      makeSong(path, i)
+
+    start = time.perf_counter()
+    expected = {path: FileHandler.getTagData(path) for path in paths}
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results, errors = FileHandler.getTagDataMany(paths)
+    many = time.perf_counter() - start
+    assert results == expected and not errors
+
+    print("{} songs".format(count))
+    print("  getTagData, one by one  {:.3f}s".format(single))
+    print("  getTagDataMany          {:.3f}s".format(many))
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -1,16 +1,31 @@
-import json, logging, os, os.path
+import json, logging, os, os.path, threading, weakref
 from time import time
 import Settings
+import SongStore
+import JobQueue
 
 settings = Settings.databaseSettings
 settings.updateDefaults({
   "videoStorageDir": "_VideoStore",
-  "databaseFile": "_data.json", # This is a big json file that contains all the information for all songs downloaded
+  "databaseBackend": "sqlite", # Either "sqlite" or "json"
+  "databaseFile": "_data.json", # This is a big json file that contains all the information for all songs downloaded. Migrated from if using sqlite
+  "sqliteFile": "_data.db",
+  "manifestFile": "_VideoStore.manifest.json", # Listing of the video folder, so an unchanged folder doesn't need to be scanned on start
+  "unavailableTTL": 7*24*3600, # Seconds a song that couldn't be downloaded (removed, private, blocked...) is skipped before trying again
+  "backgroundInitialize": True, # When started by the application, reconcile the database with the video folder in a background thread
+  "journalSyncEvery": 50, # For the json backend, number of changes between each fsync of the journal
+  "journalCompactSize": 4*1024*1024, # Journal size in bytes before it is folded into _data.json
+  "journalCompactAge": 600, # Seconds before a non-empty journal is folded into _data.json
 })
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
+# Extensions songs may have been cached with, if musicExtension was different when they were downloaded
+audioExtensions = (".mp3", ".m4a", ".opus", ".ogg", ".flac", ".webm", ".aac", ".wav")
+# Extensions of files left by a download or conversion that was cut off
+partialExtensions = (".part", ".ytdl", ".tmp", ".temp")
+
 def getVideoFolder(id=None):
   if id is not None:
     return os.path.join(settings["videoStorageDir"], id+Settings.application["musicExtension"])
@@ -24,6 +39,8 @@ Format of Database:
       author: name of the channel this video came from
       length: length of song (in seconds)
       downloadedAt: timestamp of when the song was downloaded. None or 0 for not downloaded currently
+      unavailableAt: timestamp of when the song last failed to download for good, if it did. See setUnavailable
+      unavailableReason: the error youtube-dl gave
       songTitle: alt_title, if available
       songArtist: artist, if available
       songAlbum: album, if available
@@ -31,66 +48,239 @@ Format of Database:
     }
 """
 database = {}
+_store = None # The storage backend. Every changed song is handed to it so saves only write what changed
+_ready = threading.Event() # Set once initialization has finished
+_initThread = None
+_initError = None # Exception raised while initializing in the background, if any
+_initLock = threading.RLock() # Held while starting initialization, so two threads can't both start it
+_listeners = [] # Weak references to functions called with a song's id whenever it changes, see addListener
 
-def initialize(clear=False):
-  database.clear()
-  
+def _openStore():
+  """ Creates the storage backend from settings, migrating the old json database if we are switching to sqlite """
+  if settings["databaseBackend"] == "json":
+    return SongStore.JSONStore(settings["databaseFile"], settings["journalSyncEvery"], settings["journalCompactSize"], settings["journalCompactAge"])
+  store = SongStore.SQLiteStore(settings["sqliteFile"])
+  if store.isEmpty():
+    SongStore.migrateJSON(settings["databaseFile"], store)
+  return store
+
+def _changed(id):
+  """ Tells the store and any listeners that a song has been modified and needs to be written on next save """
+  _store.put(id, database["videos"][id])
+  for reference in tuple(_listeners): # Copied, as listeners may be added or removed on another thread meanwhile
+    listener = reference()
+    if listener is None: # Its object was garbage collected
+      _discard(reference)
+    else:
+      listener(id)
+
+def _discard(reference):
+  try:
+    _listeners.remove(reference)
+  except ValueError: # Already removed
+    pass
+
+def addListener(function):
+  """
+  Calls function with a song's id every time the song's information changes. It is called on whichever thread made the change, so should be quick
+  Only a weak reference is kept, so listening doesn't keep the function's object alive. It is dropped once the object is gone
+  """
+  _listeners.append(weakref.WeakMethod(function) if hasattr(function, "__self__") else weakref.ref(function))
+
+def removeListener(function):
+  for reference in tuple(_listeners):
+    if reference() == function:
+      _discard(reference)
+
+def findOtherFormat(id):
+  """ Returns the path of a song cached with another extension than musicExtension, or None if there isn't one """
+  for extension in audioExtensions:
+    if extension != Settings.application["musicExtension"]:
+      path = os.path.join(settings["videoStorageDir"], id+extension)
+      if os.path.isfile(path):
+        return path
+  return None
+
+def _ownedIDs():
+  """
+  Ids of songs with an unfinished download job, whose partial files are still needed to resume it
+  Returns None if it can't be told, which is the case until DownloadHandler has given the job queue's file name
+  """
+  if "queueFile" not in Settings.youtubeSettings:
+    return None
+  return JobQueue.unfinishedIDs(Settings.youtubeSettings["queueFile"])
+
+def _isPartial(filename):
+  """ True for files left behind by downloading or converting a song, rather than the song itself """
+  return os.path.splitext(filename)[1] in partialExtensions or filename.endswith(".info.json") or ".temp." in filename
+
+def _readManifest():
+  try:
+    with open(settings["manifestFile"]) as file:
+      return json.load(file)
+  except (FileNotFoundError, ValueError):
+    return None
+
+def _writeManifest(files, folderTime, scannedAt):
+  """
+  Saves the listing of the video folder along with the folder's mtime, so the next start can skip scanning it
+  folderTime and scannedAt must be from before the folder was listed. A file added since then changes the folder's mtime,
+    so it won't match and the next start scans again, rather than trusting a listing that doesn't have the file
+  """
+  with open(settings["manifestFile"], "w") as file:
+    json.dump({"folderTime": folderTime, "scannedAt": scannedAt, "files": files}, file)
+
+def _listVideoFolder():
+  """
+  Returns a dict of file name to [size, mtime] for everything in the video folder, whether it was actually scanned,
+    and the folder's mtime and the time from just before it was listed, for _writeManifest
+  If the folder's mtime hasn't changed since the manifest was written, no files have been added or removed, so the manifest is used as-is
+  """
+  scannedAt = time()
+  folderTime = os.stat(getVideoFolder()).st_mtime
+  manifest = _readManifest()
+  # If the folder changed within a couple seconds of the scan, the mtime may not have ticked over (e.g. FAT has 2 second resolution), so rescan
+  if manifest and manifest["folderTime"] == folderTime and manifest["scannedAt"] - folderTime > 2:
+    log.debug("Song cache folder unchanged since last start, using manifest")
+    return manifest["files"], False, folderTime, scannedAt
+  files = {}
+  with os.scandir(getVideoFolder()) as entries:
+    for entry in entries:
+      if entry.is_file():
+        stat = entry.stat()
+        files[entry.name] = [stat.st_size, stat.st_mtime]
+  return files, True, folderTime, scannedAt
+
+def _reconcile(clear):
+  """ Loads the database and brings it in line with the files actually in the video folder """
   log.debug("Initializing song database")
-  song_files = []
-  try: 
+  song_files, scanned = {}, True
+  try:
+    scannedAt = time()
     os.makedirs(getVideoFolder())
+    folderTime = os.stat(getVideoFolder()).st_mtime
     log.debug("Created song cache folder")
-  except FileExistsError: 
-    song_files = os.listdir(getVideoFolder())
+  except FileExistsError:
+    song_files, scanned, folderTime, scannedAt = _listVideoFolder()
     log.debug("Song cache folder already exists, contains {} songs.".format(len(song_files)))
 
   if clear:
     log.info("Clearing Database")
-  else:
-    try:
-      with open(settings["databaseFile"]) as file:
-        database.update(json.load(file))
-      log.debug("Database file found and loaded")
-    except FileNotFoundError: # If there's no file yet, just ignore this
-      log.debug("Database file not found, storing in RAM")
-    
-  if "videos" not in database:
-    database["videos"] = {}
-    
+    _store.clear()
+  videos = _store.load()
+  database["videos"] = videos
+
+  extension = Settings.application["musicExtension"]
+  owned = False # Not looked up yet
+  song_ids = set()
+  for song_file in list(song_files):
+    song_id, song_ext = os.path.splitext(song_file)
+    if _isPartial(song_file):
+      # Left over from a download or conversion. Kept while a job may resume from it, otherwise removed
+      if owned is False:
+        owned = _ownedIDs()
+      if owned is None or song_file.split(".", 1)[0] in owned:
+        continue
+      log.debug("Found leftover file '{}', removing".format(song_file))
+      try:
+        os.remove(os.path.join(getVideoFolder(), song_file))
+      except OSError as e: # Still in use by something
+        log.warning("Could not remove leftover file '{}': {}".format(song_file, e))
+        continue
+      del song_files[song_file]
+      scanned = True
+    elif song_ext == extension:
+      song_ids.add(song_id)
+    elif song_ext in audioExtensions: # Cached before musicExtension changed. Kept so it can be converted rather than downloaded again
+      log.debug("Song '{}' is cached as '{}', not '{}', so counts as not downloaded".format(song_id, song_ext, extension))
+
   # Here we rectify any videos that exist in the database but not the files or vice-versa
-  for song_id in list(database["videos"]): # List so we can delete
-    if song_id+Settings.application["musicExtension"] not in song_files: # If the song's id doesn't correspond with a file
-      if not "title" in getSongOrInit(song_id): # If it is just a dummy from a previous iteration, don't include it
-        del database["videos"][song_id]
-      else:
-        getSongOrInit(song_id)["downloadedAt"] = None # Mark that video isn't downloaded
-      
+  for song_id in videos.keys() - song_ids: # If the song's id doesn't correspond with a file
+    if not "title" in videos[song_id]: # If it is just a dummy from a previous iteration, don't include it
+      del videos[song_id]
+      _store.delete(song_id)
+    elif videos[song_id]["downloadedAt"]:
+      videos[song_id]["downloadedAt"] = None # Mark that video isn't downloaded
+      _changed(song_id)
+
   # Vice-Versa
-  for song_file in song_files:
-    song_id, song_ext = os.path.splitext(song_file)
-    if song_ext not in Settings.application["musicExtension"]: # If there were any extraneous file left over, remove them at this time
-      log.debug("found extranneous file '{}', removing".format(song_file))
-      os.remove(os.path.join(getVideoFolder(), song_file))
-    elif song_id not in database["videos"]: # If the file doens't correspond to a database entry
-      log.debug("Song '{}' has file but not in database, adding dummy entry".format(song_id)) # NOTE: This could probably be done asynchronously so to not hang up load
-      getSongOrInit(song_id)["downloadedAt"] = int(time()) # Creates a blank song if it doesn't exist
-     
-  #save() # Now that all songs have been rectified
+  now = int(time())
+  for song_id in song_ids - videos.keys(): # If the file doesn't correspond to a database entry
+    log.debug("Song '{}' has file but not in database, adding dummy entry".format(song_id))
+    videos[song_id] = {"downloadedAt": now}
+    _changed(song_id)
+
+  if scanned:
+    _writeManifest(song_files, folderTime, scannedAt)
   log.info("Database module initialized")
 
+def _runReconcile(clear):
+  global _initError
+  try:
+    _reconcile(clear)
+  except BaseException as e: # Re-raised in whichever thread first needs the database
+    _initError = e
+  finally:
+    _ready.set()
+
+def _waitReady():
+  """
+  Blocks until initialization has finished. Every function that uses the database must call this first
+  If nothing has initialized the database yet, it is initialized now
+  """
+  if _store is None:
+    with _initLock:
+      if _store is None:
+        initialize()
+  _ready.wait()
+  if _initError is not None:
+    raise RuntimeError("Database failed to initialize") from _initError
+
+def initialize(clear=False, background=False):
+  """
+  Opens the database and reconciles it with the video folder
+  :param background: If true, reconciliation runs in a separate thread and this returns immediately.
+    Any function in this module will wait for it to finish
+  """
+  global _store, _initError, _initThread
+  with _initLock:
+    if _initThread is not None and _initThread.is_alive():
+      _initThread.join()
+    _ready.clear()
+    _initError = None
+    database.clear()
+    if _store is not None:
+      _store.close()
+    _store = _openStore()
+
+    if background:
+      _initThread = threading.Thread(target=_runReconcile, args=(clear,), name="DatabaseInit", daemon=True)
+      _initThread.start()
+  if not background:
+    _runReconcile(clear)
+    _waitReady()
+
 def getSong(id):
+  _waitReady()
   return database["videos"][id]
 
+def hasSong(id):
+  _waitReady()
+  return id in database["videos"]
+
 def getSongOrInit(id):
   """ Gets the song, or initializes a new one if doesn't exist """
+  _waitReady()
   try:
     return database["videos"][id]
   except KeyError:
     toRet = {"downloadedAt": None}
     database["videos"][id] = toRet
+    _changed(id)
     return toRet
     
 def isDownloaded(id):
+  _waitReady()
   try:
     return bool(database["videos"][id]["downloadedAt"])
   except KeyError:
@@ -101,6 +291,7 @@ def addSongFromDict(inDict):
   This takes in a dictionary and updates our database from it. Dict should be from a song, flat-playlist, or a playlist entry
   Returns dict of song added, or list of songs added if flat-playlist
   """
+  _waitReady()
   # If playlist, add all songs from inside
   if "_type" in inDict:
     if inDict["_type"] == "playlist":
@@ -109,6 +300,7 @@ def addSongFromDict(inDict):
       log.debug("Adding playlist song: "+inDict["title"])
       songDict = getSongOrInit(inDict["id"])
       songDict["title"] = inDict["title"]
+      _changed(inDict["id"])
       return inDict["id"]
   else: # Otherwise assume its a full song dict
     songDict = getSongOrInit(inDict["id"])
@@ -121,6 +313,7 @@ def addSongFromDict(inDict):
       ("songAlbum", "album")
     ):
       songDict[myKey] = inDict[theirKey]
+    _changed(inDict["id"])
     for key in ("formats", "requested_formats"): # These are like horrendously long, and time-dependant so don't save it
       if key in inDict:
         del inDict[key]
@@ -129,18 +322,40 @@ def addSongFromDict(inDict):
   
 def setDownloaded(id, state=True):
   """ Sets a video as downloaded or deleted """
-  getSongOrInit(id)["downloadedAt"] = int(time()) if state else None
+  _waitReady()
+  songDict = getSongOrInit(id)
+  songDict["downloadedAt"] = int(time()) if state else None
+  if state:
+    songDict.pop("unavailableAt", None)
+    songDict.pop("unavailableReason", None)
+  _changed(id)
+
+def setUnavailable(id, reason=None):
+  """ Remembers that a song can't be downloaded, so syncing doesn't keep asking youtube for it. See isUnavailable """
+  _waitReady()
+  songDict = getSongOrInit(id)
+  songDict["unavailableAt"] = int(time())
+  songDict["unavailableReason"] = reason
+  _changed(id)
+
+def isUnavailable(id):
+  """ True if the song failed to download for good within the last "unavailableTTL" seconds """
+  _waitReady()
+  unavailableAt = database["videos"].get(id, {}).get("unavailableAt")
+  return bool(unavailableAt) and time() - unavailableAt < settings["unavailableTTL"]
 
 def save():
+  """ Writes every song changed since the last save to the store """
+  _waitReady()
   log.debug("Saving database")
-  with open(settings["databaseFile"], "w") as file:
-    json.dump(database, file)
+  _store.flush()
   
 def printSongs():
   def clamp(string, size):
     if len(string) > size:
       string = string[:size-2] + ".."
     return string.ljust(size)
+  _waitReady()
 
   copy = database["videos"].copy()
   for key in list(copy):
@@ -152,5 +367,3 @@ def printSongs():
   print(("-"*19+"+")*3+"-"*20, end="")
   for key, value in sorted(copy.items(), key=lambda tup: tup[1]["title"]):
     print("|".join(clamp(value[i] or "", 19) for i in keys))
-  
-initialize()
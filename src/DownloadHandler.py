@@ -1,11 +1,13 @@
-import json, io, subprocess, re, os, threading, logging
-from concurrent.futures import ThreadPoolExecutor, wait as ThreadWait
+import json, io, subprocess, re, os, threading, logging, hashlib, heapq, random, shutil
+from collections import deque, OrderedDict
+from time import monotonic, sleep, time
+from concurrent.futures import Future, ThreadPoolExecutor, wait as ThreadWait
 
-# NOTE: FOR FUTURE https://github.com/ytdl-org/youtube-dl/#embedding-youtube-dl
 # This module should only handle downloading the videos and putting them in the cache, updating the data store
 
 import Settings
 import DatabaseHandler
+import JobQueue
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
@@ -15,54 +17,570 @@ settings = Settings.youtubeSettings
 #This will be an object that handles inheritance, getting and setting in a sane way, etc.
 settings.updateDefaults({
   "concurrentDownloads": 8,
-  "youtube_dl": r"resources\youtube-dl.exe",
+  "metadataWorkers": 4, # Playlist and song information fetched at once. Separate from downloads, so a sync doesn't wait behind them
+  # Downloading and converting to mp3 are done as separate steps, so each can have as many workers as suits it
+  #   Otherwise youtube-dl converts each song itself, in the same worker that downloaded it
+  "separateTranscode": True,
+  "transcodeWorkers": os.cpu_count() or 2, # Songs converted at once. Converting is CPU-bound, so more than the number of cores doesn't help
+  "transcodeQueueSize": 8, # Downloaded songs that can wait to be converted. Once full, downloads wait for a free spot
+  "stagingDir": "_Staging", # Where downloads wait to be converted
+  "ffmpeg": r"resources\ffmpeg.exe", # Path to ffmpeg, used to convert songs. Shipped next to youtube-dl, which finds it there itself
+  # "native": Prefer audio streams that can be stored as Settings.application["musicExtension"] without converting them, see VideoProcessor.formats
+  # "transcode": Always download the best audio and convert it
+  "formatPolicy": "native",
+  "backend": "subprocess", # "subprocess" runs youtube-dl for every call, "embedded" uses the youtube_dl python package in-process
+  "youtube_dl": r"resources\youtube-dl.exe", # Either a path to the executable, or a list of arguments to run it with
   "pipeOptions": {"universal_newlines": True, "stderr": subprocess.STDOUT},
   "formatString": "%(id)s.%(ext)s",
-  "youtubeWait": 0.1, # Time in between each call to youtube.com
-  "youtubeSettings": {},
+  "metadataRate": 10, # Calls per second allowed to youtube.com for playlist and song information. 0 for no limit
+  "metadataBurst": 5, # Calls that can be made at once after being idle
+  "downloadRate": 10, # Calls per second allowed to youtube.com for downloading songs. 0 for no limit
+  "downloadBurst": 2,
+  "progressRate": 4, # Maximum number of progress updates passed on per song per second
+  "outputLines": 200, # Number of lines of youtube-dl output kept for each song, for error reporting
+  "infoCacheFile": "_infoCache.json", # Playlist and song information saved between runs
+  "infoCacheTTL": 3600, # Seconds cached information is used before asking youtube again
+  "infoCacheSize": 500, # Number of playlists and songs kept in the cache, least recently used are dropped first
+  "queueFile": "_queue.db", # Songs waiting to be downloaded, so they can be picked up again after a restart
+  "maxAttempts": 5, # Times a song is tried before giving up on it, unless the failure is permanent
+  "retryDelay": 30, # Seconds before the first retry of a failed download. Doubles with each attempt
+  "retryMaxDelay": 1800,
+  "youtubeSettings": {}, # Extra command line options for the subprocess backend
+  "embeddedSettings": {}, # Extra YoutubeDL params for the embedded backend, see youtube_dl/YoutubeDL.py
 })
 
 
-class TimedLock:
-  """ 
-  This is a lock that you only need to acquire, and will automatically free after a timer
-  The point of this is that we should have a certain amount of time in between requests to youtube to prevent being rate limited
+class RateLimiter:
   """
+  A token bucket limiting how often we call youtube.com, so that we don't get rate limited
+  Tokens refill at "rate" per second up to "burst", and each call takes one. Callers that find the bucket empty
+    reserve a token anyway and sleep until it would have refilled, so no timer threads are needed and waiters go in order
+  If youtube tells us to slow down anyway, backoff() pushes every caller back, doubling each time until a call succeeds
+  """
+
+  def __init__(self, rate: float, burst: int = 1, clock=monotonic, sleep=sleep, baseBackoff=1.0, maxBackoff=60.0):
+    """
+    rate: calls allowed per second. 0 or less means unlimited
+    burst: number of calls that can be made at once after being idle
+    clock, sleep: time functions, replaceable for testing
+    """
+    self.lock = threading.Lock()
+    self.clock = clock
+    self.sleep = sleep
+    self.baseBackoff = baseBackoff
+    self.maxBackoff = maxBackoff
+    self.penalty = 0.0 # Current backoff, in seconds
+    self.last = clock()
+    self.setRate(rate, burst)
+    self.tokens = self.burst
+
+  def setRate(self, rate, burst=None):
+    with self.lock:
+      self.rate = rate
+      if burst is not None:
+        self.burst = max(1, burst)
+
+  def refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def acquire(self):
+    """ Waits until a call is allowed. Returns the time spent waiting """
+    with self.lock:
+      if self.rate <= 0:
+        return 0.0
+      self.refill()
+      self.tokens -= 1
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+    if wait > 0:
+      self.sleep(wait)
+    return wait
+
+  def backoff(self):
+    """ Called when youtube says we are making too many requests """
+    with self.lock:
+      self.penalty = min(self.maxBackoff, self.penalty*2 if self.penalty else self.baseBackoff)
+      if self.rate > 0:
+        self.refill()
+        self.tokens = min(self.tokens, 0) - self.penalty * self.rate
+    log.warning("Rate limited by youtube, backing off for {} seconds".format(self.penalty))
+
+  def succeed(self):
+    """ Called after a call that wasn't rate limited """
+    with self.lock:
+      self.penalty = 0.0
+
+
+class ProgressThrottle:
+  """
+  Wraps an output function so that each song passes on at most "rate" updates per second. Updates in between are dropped,
+    except for the one at 100% so consumers always see a download finish
+  Downloads report progress many times a second from every worker, which would otherwise flood the GUI's event queue
+  """
+
+  def __init__(self, outputFunction, rate, clock=monotonic):
+    self.outputFunction = outputFunction
+    self.interval = 1 / rate if rate > 0 else 0
+    self.clock = clock
+    self.lastSent = {} # Song to time of the last update passed on
+
+  def __call__(self, song, percent, downloadRate):
+    now = self.clock()
+    if percent < 100 and now - self.lastSent.get(song, float("-inf")) < self.interval:
+      return
+    self.lastSent[song] = now
+    self.outputFunction(song, percent, downloadRate)
+
+
+def flattenDict(inputDict: dict) -> list:
+  """ Flattens a dictionary into a list where values follow keys. Used for making command line arguments """
+  return sum([[key] if type(value) is bool else [key, value] for key, value in inputDict.items() if value], list())
+
+
+class SubprocessBackend:
+  """ Runs a new youtube-dl process for every download and info request """
+
+  progressPattern = re.compile(r"\[download\]\s+([\d.]+)% of \S+ at\s+([\d.]+\S+)")
+
+  @staticmethod
+  def command():
+    executable = settings["youtube_dl"]
+    return list(executable) if isinstance(executable, (list, tuple)) else [executable]
 
-  def __init__(self, timeout: float):
+  def download(self, song, options, outputTemplate, outputFunction=None):
     """
-    timeout: the time after the lock is acquired that it will be released, in seconds
+    :param options: Dict of youtube-dl command line options, see VideoProcessor.downloadSong
+    :return: (Return code, the last lines of stdout and stderr returned by youtube-dl)
     """
+    obj = subprocess.Popen(
+      self.command() + # Executable
+      flattenDict(options) + #Turn the dict items into a list where key is before value. Bools are special. If false, not added, otherwise only key
+      ["-o", outputTemplate] + #Output format and folder
+      ["--", song], #Then add song as input
+      **settings["pipeOptions"], #Add in subprocess options
+      stdout=subprocess.PIPE #Also this for now
+    )
+    
+    output = deque(maxlen=settings["outputLines"]) # Only the end of the output is kept, which is where errors are
+    for line in obj.stdout:
+      output.append(line)
+      if callable(outputFunction) and line.startswith("[download]"):
+        match = self.progressPattern.match(line) #Matches the download update lines
+        if match:
+          percent, downloadRate = match.group(1, 2)
+          outputFunction(song, float(percent), downloadRate) #Update this if we have items
+    return obj.wait(), "".join(output) # Wait for process to complete and get return code. Also return the end of the output printed to stdout
+
+  def getInfo(self, url, playlist=True):
+    try:
+      #                                                                                                                                             -- in case youtube url begins with "-"
+      output = subprocess.check_output(self.command() + ["-J", "--flat-playlist", "--yes-playlist" if playlist else "--no-playlist"] + flattenDict(settings["youtubeSettings"]) + ["--", url],
+               **settings["pipeOptions"])
+    except subprocess.CalledProcessError as e:
+      return e.output
+    else:
+      return json.loads(output)
+
+
+class EmbeddedBackend:
+  """
+  Uses the youtube_dl package in-process, which saves starting a process and loading every extractor for each song
+  Each worker thread keeps a YoutubeDL object for each set of options it uses, so getting information, downloading and
+    downloading to be converted can take turns on the same thread without rebuilding one each time
+  https://github.com/ytdl-org/youtube-dl/#embedding-youtube-dl
+  """
+
+  rateUnits = ("B/s", "KiB/s", "MiB/s", "GiB/s") # So progress looks the same as youtube-dl's printed output
+  instancesPerThread = 4 # YoutubeDL objects kept by each thread, least recently used are dropped first
+
+  class Logger:
+    """ Collects everything youtube_dl would have printed, so it can be returned like the subprocess output """
+    def __init__(self):
+      self.lines = deque(maxlen=settings["outputLines"])
+    def debug(self, msg):
+      self.lines.append(msg)
+    warning = debug
+    error = debug
+
+  def __init__(self):
+    import youtube_dl # Only needed if this backend is used
+    self.youtube_dl = youtube_dl
+    self.local = threading.local()
+
+  @staticmethod
+  def toParams(options):
+    """ Translates the command line options VideoProcessor uses into YoutubeDL params """
+    params = {}
+    if options.get("-f"):
+      params["format"] = options["-f"]
+    if options.get("-x"):
+      params["format"] = options.get("-f") or "bestaudio/best"
+      params["postprocessors"] = [{
+        "key": "FFmpegExtractAudio",
+        "preferredcodec": options.get("--audio-format", "best"),
+        "preferredquality": options.get("--audio-quality", "5"),
+      }]
+    if options.get("--write-info-json"):
+      params["writeinfojson"] = True
+    if options.get("--continue"):
+      params["continuedl"] = True
+    return params
+
+  def getYoutubeDL(self, params):
+    """ Returns this thread's YoutubeDL object for these params, making a new one if the thread doesn't have one yet """
+    params = dict(params, **settings["embeddedSettings"])
+    key = json.dumps(params, sort_keys=True, default=repr)
+    instances = getattr(self.local, "instances", None)
+    if instances is None:
+      instances = self.local.instances = OrderedDict() # Params key to (YoutubeDL, Logger)
+      self.local.outputFunction = None
+    if key in instances:
+      instances.move_to_end(key)
+    else:
+      logger = self.Logger()
+      params.update({"logger": logger, "progress_hooks": [self.progressHook], "noprogress": True})
+      instances[key] = (self.youtube_dl.YoutubeDL(params), logger)
+      if len(instances) > self.instancesPerThread:
+        instances.popitem(last=False)
+    youtubeDL, self.local.logger = instances[key]
+    self.local.logger.lines.clear()
+    return youtubeDL
+
+  def progressHook(self, status):
+    """ Called by youtube_dl on the downloading thread, so that thread's output function is used """
+    outputFunction = self.local.outputFunction
+    if status["status"] != "downloading" or not callable(outputFunction):
+      return
+    total = status.get("total_bytes") or status.get("total_bytes_estimate")
+    percent = 100.0 * status.get("downloaded_bytes", 0) / total if total else 0.0
+    rate, unit = status.get("speed") or 0.0, 0
+    while rate >= 1024 and unit < len(self.rateUnits)-1:
+      rate, unit = rate / 1024, unit+1
+    outputFunction(self.local.song, percent, "{:.2f}{}".format(rate, self.rateUnits[unit]))
+
+  def download(self, song, options, outputTemplate, outputFunction=None):
+    youtubeDL = self.getYoutubeDL(dict(self.toParams(options), outtmpl=outputTemplate))
+    self.local.song, self.local.outputFunction = song, outputFunction
+    try:
+      code = youtubeDL.download([song])
+    except self.youtube_dl.utils.DownloadError:
+      code = 1 # The error has already been sent to our logger
+    finally:
+      self.local.outputFunction = None
+    return code, "\n".join(self.local.logger.lines)
+
+  def getInfo(self, url, playlist=True):
+    youtubeDL = self.getYoutubeDL({"extract_flat": "in_playlist", "noplaylist": not playlist, "skip_download": True})
+    try:
+      return youtubeDL.extract_info(url, download=False)
+    except self.youtube_dl.utils.DownloadError:
+      return "\n".join(self.local.logger.lines)
+
+
+class InfoCache:
+  """
+  Keeps the results of getInfo on disk so that syncing doesn't need to ask youtube about every playlist every time
+  Entries are used until they are "ttl" seconds old, and only the "size" most recently used are kept.
+  Youtube doesn't give us anything like an ETag, so each entry stores a fingerprint of its contents instead.
+    Anything that processed a playlist can remember the fingerprint and skip the work if it is the same next time
+  """
+
+  def __init__(self, filename, ttl, size, clock=time):
+    self.filename = filename
+    self.ttl = ttl
+    self.size = size
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.entries = OrderedDict() # Key to dict of "fetchedAt", "fingerprint", and "info". Ordered from least to most recently used
+    self.dirty = False
+    try:
+      with open(filename) as file:
+        self.entries.update(json.load(file))
+    except (FileNotFoundError, ValueError):
+      pass
+
+  @staticmethod
+  def fingerprint(info):
+    """ A hash of the ids of a playlist's entries (in order), or of the whole info for a single song """
+    if "entries" in info:
+      data = json.dumps([entry.get("id") for entry in info["entries"]])
+    else:
+      data = json.dumps(info, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+  def get(self, key):
+    """ Returns the cached info, or None if there is none or it has expired """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or self.clock() - entry["fetchedAt"] >= self.ttl:
+        return None
+      self.entries.move_to_end(key)
+      return entry["info"]
+
+  def put(self, key, info):
+    """ Stores new info. Returns True if it differs from what was cached before """
+    fingerprint = self.fingerprint(info)
+    with self.lock:
+      old = self.entries.pop(key, None)
+      self.entries[key] = {"fetchedAt": self.clock(), "fingerprint": fingerprint, "info": info}
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+      self.dirty = True
+    return old is None or old["fingerprint"] != fingerprint
+
+  def invalidate(self, key):
+    with self.lock:
+      if self.entries.pop(key, None) is not None:
+        self.dirty = True
+
+  def save(self):
+    with self.lock:
+      if not self.dirty:
+        return
+      tempFile = self.filename+".tmp"
+      with open(tempFile, "w") as file:
+        json.dump(self.entries, file)
+      os.replace(tempFile, self.filename)
+      self.dirty = False
+
+
+class StageMetrics:
+  """ Counts the work done by one stage of downloading a song, so the number of workers for each can be tuned """
+
+  def __init__(self, clock=monotonic):
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.created = clock()
+    self.done = 0
+    self.failed = 0
+    self.active = 0 # Songs in this stage right now
+    self.busy = 0.0 # Total seconds spent working on songs
+    self.blocked = 0.0 # Total seconds spent waiting for the next stage to have room
+
+  def begin(self):
+    """ Call when starting on a song. Returns a value to give to end """
+    with self.lock:
+      self.active += 1
+    return self.clock()
+
+  def end(self, began, success):
+    with self.lock:
+      self.active -= 1
+      self.busy += self.clock() - began
+      if success:
+        self.done += 1
+      else:
+        self.failed += 1
+
+  def addBlocked(self, seconds):
+    with self.lock:
+      self.blocked += seconds
+
+  def snapshot(self):
+    """ Returns a dict of the counts, plus songs per minute and the average seconds spent on each """
+    with self.lock:
+      finished = self.done + self.failed
+      elapsed = self.clock() - self.created
+      return {
+        "done": self.done, "failed": self.failed, "active": self.active, "busySeconds": self.busy, "blockedSeconds": self.blocked,
+        "perMinute": 60 * self.done / elapsed if elapsed > 0 else 0.0,
+        "averageSeconds": self.busy / finished if finished else 0.0,
+      }
+
+
+# Download priorities, most urgent first
+INTERACTIVE = 0 # A song the user asked for
+NEW_PLAYLIST = 1 # Songs of a playlist that was just added
+BACKFILL = 2 # Everything else
+
+class DownloadJob:
+  """ A song waiting for a worker, or being processed by one """
+
+  def __init__(self, songID, priority=BACKFILL, group=None, outputFunction=None, completeFunc=None):
+    self.songID = songID
+    self.priority = priority
+    self.group = group # Jobs in the same group (a playlist or MusicSet) share their turns with other groups, see DownloadQueue
+    self.outputFunction = outputFunction
+    self.completeFuncs = [completeFunc] if callable(completeFunc) else [] # Everyone that submitted the song and wants to know when it's done
+    self.future = Future() # Result is whether the song was eventually downloaded
+
+  def merge(self, other):
+    """ Takes on the callbacks of another job for the same song, which won't be run itself """
+    self.completeFuncs.extend(other.completeFuncs)
+    if self.outputFunction is None:
+      self.outputFunction = other.outputFunction
+
+  def complete(self, success):
+    """ Calls every completeFunc with the outcome. One failing doesn't stop the others from being told """
+    for completeFunc in self.completeFuncs:
+      try:
+        completeFunc(self.songID, success)
+      except Exception:
+        log.exception("Completion callback for song '{}' failed".format(self.songID))
+
+
+class DownloadQueue:
+  """
+  Jobs waiting for a worker. The most urgent priority always goes first, and within a priority
+    groups take turns, so a playlist of thousands of songs can't hold up a small one added after it
+  Jobs that have been taken stay known until done is called, so a song is never downloaded twice at once
+  """
+
+  def __init__(self):
     self.lock = threading.Lock()
-    self.timeout = timeout
+    self.levels = {} # Priority to OrderedDict of group to deque of jobs. The group at the front has the next turn
+    self.waiting = {} # Song id to its waiting job
+    self.running = {} # Song id to its job, for jobs taken by get that aren't done, including those waiting to be retried
+
+  def __len__(self):
+    return len(self.waiting)
+
+  def _add(self, job):
+    self.waiting[job.songID] = job
+    self.levels.setdefault(job.priority, OrderedDict()).setdefault(job.group, deque()).append(job)
+
+  def _remove(self, job):
+    del self.waiting[job.songID]
+    groups = self.levels[job.priority]
+    groups[job.group].remove(job)
+    if not groups[job.group]:
+      del groups[job.group]
 
-  def setTime(self, timeout):
-    self.timeout = timeout
+  def put(self, job):
+    """
+    Queues a job and returns it. If the song is already waiting or running, the job already there is returned instead,
+      with this job's callbacks merged into it, and moved up to this job's priority if it's waiting and that is more urgent
+    A running job that is put again, to be retried, goes back to waiting
+    """
+    with self.lock:
+      existing = self.waiting.get(job.songID)
+      if existing is None:
+        existing = self.running.get(job.songID)
+        if existing is job:
+          del self.running[job.songID]
+          existing = None
+      if existing is None:
+        self._add(job)
+        return job
+      existing.merge(job)
+      if job.priority < existing.priority and job.songID in self.waiting:
+        self._remove(existing)
+        existing.priority = job.priority
+        self._add(existing)
+      return existing
+
+  def get(self):
+    """ Takes the next job to run, or returns None if nothing is waiting """
+    with self.lock:
+      for priority in sorted(self.levels):
+        groups = self.levels[priority]
+        if groups:
+          group, jobs = next(iter(groups.items()))
+          job = jobs.popleft()
+          if jobs:
+            groups.move_to_end(group) # Its turn is over
+          else:
+            del groups[group]
+          del self.waiting[job.songID]
+          self.running[job.songID] = job
+          return job
+      return None
 
-  def acquire(self, *args, **kwargs):
-    if self.timeout > 0:
-      if self.lock.acquire(*args, **kwargs): # This statement will wait until the lock has been acquired
-        log.debug("Lock acquired. Waiting {} seconds before next call".format(self.timeout))
-        threading.Timer(self.timeout, self.lock.release).start() # After a given timer, releases the underlying lock
-        return True # If we succeed in acquiring the lock, start a timer to release the lock
-      return False # If we fail at acquiring the lock, don't do anything else
-    return True # If there is no timeout, we always succeed
+  def done(self, job):
+    """ Forgets a job taken by get once it has finished for good. A song submitted after this is downloaded again """
+    with self.lock:
+      if self.running.get(job.songID) is job:
+        del self.running[job.songID]
+
+  def reprioritise(self, songID, priority):
+    """ Changes the priority of a waiting song. Returns False if it isn't waiting """
+    with self.lock:
+      job = self.waiting.get(songID)
+      if job is None:
+        return False
+      self._remove(job)
+      job.priority = priority
+      self._add(job)
+      return True
+
+  def remove(self, songID):
+    """ Takes a song out of the queue, returning its job, or None if it isn't waiting """
+    with self.lock:
+      job = self.waiting.get(songID)
+      if job is not None:
+        self._remove(job)
+      return job
+
+
+class RetryScheduler:
+  """
+  Runs functions on an executor after a delay, so that a song waiting to be retried doesn't hold a worker
+  Waiting calls are kept in a heap ordered by due time, and one thread sleeps until the next one is due
+  """
+
+  def __init__(self, executor, clock=monotonic):
+    self.executor = executor
+    self.clock = clock
+    self.condition = threading.Condition()
+    self.heap = [] # (due time, sequence number, function, args)
+    self.counter = 0 # Keeps calls due at the same time in the order they were scheduled
+    self.thread = None
+
+  def schedule(self, delay, function, *args):
+    with self.condition:
+      self.counter += 1
+      heapq.heappush(self.heap, (self.clock() + delay, self.counter, function, args))
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name="RetryScheduler", daemon=True)
+        self.thread.start()
+      self.condition.notify()
+
+  def pending(self):
+    with self.condition:
+      return len(self.heap)
+
+  def run(self):
+    while True:
+      with self.condition:
+        while not self.heap or self.heap[0][0] > self.clock():
+          self.condition.wait(self.heap[0][0] - self.clock() if self.heap else None)
+        due, count, function, args = heapq.heappop(self.heap)
+      self.executor.submit(function, *args)
+
+
+backends = {
+  "subprocess": SubprocessBackend,
+  "embedded": EmbeddedBackend,
+}
 
 
 class VideoProcessor:
 
   def __init__(self):
     self.executor = ThreadPoolExecutor(max_workers=settings["concurrentDownloads"])
-    self.youtubeLock = TimedLock(settings["youtubeWait"])
-    log.info("Initialized Download and Conversion Processor")
+    self.metadataExecutor = ThreadPoolExecutor(max_workers=settings["metadataWorkers"]) # For getInfo calls made in the background
+    self.metadataLimiter = RateLimiter(settings["metadataRate"], settings["metadataBurst"])
+    self.downloadLimiter = RateLimiter(settings["downloadRate"], settings["downloadBurst"])
+    self.backend = backends[settings["backend"]]()
+    self.infoCache = InfoCache(settings["infoCacheFile"], settings["infoCacheTTL"], settings["infoCacheSize"])
+    self.jobs = JobQueue.JobQueue(settings["queueFile"])
+    self.queue = DownloadQueue()
+    self.retries = RetryScheduler(self.executor)
+    # Second stage of downloading, see runJob. The semaphore bounds the songs waiting for or being converted
+    self.transcoder = ThreadPoolExecutor(max_workers=settings["transcodeWorkers"])
+    self.transcodeSlots = threading.Semaphore(settings["transcodeWorkers"] + settings["transcodeQueueSize"])
+    self.metrics = {"download": StageMetrics(), "transcode": StageMetrics()}
+    log.info("Initialized Download and Conversion Processor with {} backend".format(settings["backend"]))
     
     # A set of options. On song download, additional options and those from "settings" are also added
-    self.audioOptions = {"-x": True, "--audio-format": "mp3", "--audio-quality": "0"}
+    # --continue picks up from the .part file of a download that was interrupted
+    # youtube-dl's -x only converts if the stream isn't in --audio-format already, so -f asks for one that is where possible
+    self.audioOptions = {"-x": True, "-f": self.formatSelector(), "--audio-format": self.targetFormat()[0], "--audio-quality": "0", "--continue": True}
+    # Options for the download stage when songs are converted separately. The audio as youtube has it
+    self.stageOptions = {"-f": self.formatSelector(), "--continue": True}
     
-  @staticmethod
-  def flattenDict(inputDict: dict) -> list:
-    """ Flattens a dictionary into a list where values follow keys. Used for making command line arguments """
-    return sum([[key] if type(value) is bool else [key, value] for key, value in inputDict.items() if value], list())
+  flattenDict = staticmethod(flattenDict)
     
   def _testPlaylist(self, url):
     futures = []
@@ -78,15 +596,165 @@ class VideoProcessor:
       ThreadWait(futures)
     finally:
       DatabaseHandler.save()
+      self.infoCache.save()
       for future in futures:
         if not future.result():
           ids.remove(future.id_)
           print(future.id_)
     return ids
 
-  def submitSong(self, songID, *args, **kwargs):
+  def submitSong(self, songID, outputFunction=None, completeFunc=None, playlist=None, priority=BACKFILL, group=None):
+    """
+    Queues a song to be processed on the worker pool, see processSong for arguments
+    The job is recorded in the job queue first, so it is picked up again by resumeJobs if we stop before it finishes
+    Downloads that fail for a reason that may go away are retried later, see runJob
+    :param playlist: Id of the playlist the song is for, stored with the job
+    :param priority: One of INTERACTIVE, NEW_PLAYLIST or BACKFILL. More urgent songs are always started first
+    :param group: Songs in different groups take turns with each other, see DownloadQueue. Defaults to the playlist
+    :return: A future for whether the song was eventually downloaded. completeFunc is only called once it is known.
+      If the song was already waiting or being processed, this is the future of that job, and completeFunc is called when it finishes
+    """
     log.debug("Submitting song '{}' for processing".format(songID))
-    return self.executor.submit(self.processSong, songID, *args, **kwargs)
+    self.jobs.add(songID, playlist)
+    job = DownloadJob(songID, priority, playlist if group is None else group, outputFunction, completeFunc)
+    queued = self.queue.put(job)
+    if queued is job:
+      self.executor.submit(self.runNext)
+    return queued.future
+
+  def runNext(self):
+    """ Runs whichever job is most urgent right now. One of these is submitted to the executor for every job queued """
+    job = self.queue.get()
+    if job is not None: # Unless it was cancelled
+      self.runJob(job)
+
+  def reprioritise(self, songID, priority):
+    """ Changes the priority of a song that is waiting to be processed. Returns False if it isn't waiting """
+    return self.queue.reprioritise(songID, priority)
+
+  def cancel(self, songID):
+    """ Stops a song that is waiting to be processed from being processed. Returns False if it isn't waiting """
+    job = self.queue.remove(songID)
+    if job is None:
+      return False
+    log.debug("Cancelled song '{}'".format(songID))
+    self.jobs.remove(songID)
+    job.future.cancel()
+    return True
+
+  def requeue(self, job):
+    """ Puts a job that is being retried back in the queue. Anyone that submitted the song meanwhile was merged into it """
+    self.queue.put(job)
+    self.runNext()
+
+  def runJob(self, job):
+    """
+    Runs one attempt at a song, recording its progress in the job queue
+    If "separateTranscode" is set, this only downloads the song, and converting it is handed to the transcode pool.
+      The hand-off waits while that pool has "transcodeQueueSize" songs waiting, so downloads can't run far ahead of it
+    """
+    songID = job.songID
+    self.jobs.start(songID)
+    metrics = self.metrics["download"]
+    began = metrics.begin()
+    try:
+      if settings["separateTranscode"]:
+        success, text = self.stageSong(songID, job.outputFunction)
+      else:
+        success, text = self.fetchSong(songID, job.outputFunction)
+    except Exception as e:
+      metrics.end(began, False)
+      self.failJob(job, e)
+      return
+    metrics.end(began, success)
+    if success and settings["separateTranscode"]:
+      waitStart = monotonic()
+      self.transcodeSlots.acquire()
+      metrics.addBlocked(monotonic() - waitStart)
+      self.transcoder.submit(self.transcodeJob, job, text)
+    else:
+      self.finishJob(job, success, text)
+
+  def transcodeJob(self, job, text):
+    """ Second stage of runJob, converts a downloaded song and puts it in the video folder """
+    metrics = self.metrics["transcode"]
+    began = metrics.begin()
+    try:
+      success, output = self.transcodeSong(job.songID)
+    except Exception as e:
+      metrics.end(began, False)
+      self.failJob(job, e)
+      return
+    finally:
+      self.transcodeSlots.release()
+    metrics.end(began, success)
+    self.finishJob(job, success, text + output)
+
+  def failJob(self, job, error):
+    """ Records an attempt that raised an exception. The song isn't tried again, as the same thing would likely happen """
+    log.error("Song '{}' failed: {}".format(job.songID, error))
+    self.queue.done(job)
+    self.jobs.finish(job.songID, False, str(error))
+    try:
+      job.complete(False)
+    finally:
+      job.future.set_exception(error)
+
+  def finishJob(self, job, success, text):
+    """ Records the outcome of an attempt at a song. If it failed but may work later, schedules another attempt instead """
+    songID = job.songID
+    if not success:
+      failure = self.classifyFailure(text)
+      attempts = self.jobs.get(songID)["attempts"]
+      if failure == "permanent":
+        log.warning("Song '{}' can't be downloaded, not trying again".format(songID))
+        DatabaseHandler.setUnavailable(songID, text.strip().splitlines()[-1] if text.strip() else None)
+      elif attempts < settings["maxAttempts"]:
+        delay = self.retryDelay(attempts)
+        log.info("Song '{}' failed to download, trying again in {:.0f} seconds".format(songID, delay))
+        self.jobs.retry(songID, text) # Back in the queue, so a restart picks it up too
+        self.retries.schedule(delay, self.requeue, job)
+        return
+    self.queue.done(job)
+    self.jobs.finish(songID, success, None if success else text)
+    try:
+      job.complete(success)
+    finally:
+      job.future.set_result(success)
+
+  def getMetrics(self):
+    """ Returns a dict of stage name to StageMetrics.snapshot, plus the number of songs waiting to start """
+    toRet = {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+    toRet["queued"] = len(self.queue)
+    return toRet
+
+  @staticmethod
+  def retryDelay(attempts):
+    """ Exponential backoff with jitter, so songs that failed together don't all retry at once """
+    delay = min(settings["retryMaxDelay"], settings["retryDelay"] * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+  # Youtube-dl errors that won't go away by trying again. Anything else (network errors, throttling...) is assumed to be transient
+  permanentPattern = re.compile(
+    r"Video unavailable|This video (?:is|has been) (?:no longer available|removed|private|unavailable)|Private video"
+    r"|not (?:made )?available in your country|blocked it (?:in your country|on copyright grounds)|account associated with this video has been terminated"
+    r"|Sign in to confirm your age|members-only|Unsupported URL|Incomplete YouTube ID",
+    re.IGNORECASE
+  )
+
+  def classifyFailure(self, output):
+    """ Returns "permanent" or "transient" for a failed download's output """
+    return "permanent" if self.permanentPattern.search(output or "") else "transient"
+
+  def resumeJobs(self, outputFunction=None, completeFunc=None):
+    """
+    Submits every job that was queued or running when the program last stopped. Partly downloaded songs carry on from their .part file
+    :return: List of futures, one for each job
+    """
+    jobs = self.jobs.unfinished()
+    if jobs:
+      log.info("Resuming {} unfinished downloads".format(len(jobs)))
+    return [self.submitSong(job["id"], outputFunction, completeFunc, playlist=job["playlist"]) for job in jobs]
 
   def processSong(self, songID, outputFunction=None, completeFunc=None):
     """
@@ -94,6 +762,13 @@ class VideoProcessor:
     :param songID: Should be the id of the song, not the youtube url
     :param completeFunc: Should be a function that takes two parameters: songID, and True/False for success
     """
+    success, text = self.fetchSong(songID, outputFunction)
+    if callable(completeFunc):
+      completeFunc(songID, success)
+    return success
+
+  def fetchSong(self, songID, outputFunction=None):
+    """ Does the work of processSong. Returns (True/False for success, youtube-dl's output) """
     if "/" in songID:
       raise AssertionError("processSong cannot handle URLs, only youtube video ids")
     
@@ -102,27 +777,97 @@ class VideoProcessor:
     
     exit_code, text = self.downloadSong(songID, outputFolder = videoDir, outputFunction = outputFunction)
     if exit_code != 0: # If not successful, don't continue
-      if callable(completeFunc):
-        completeFunc(songID, False)
-      return False
+      return False, text
     
     with open(infoFile) as file:
       DatabaseHandler.addSongFromDict(json.load(file))
     os.remove(infoFile)
     
     DatabaseHandler.setDownloaded(songID)
-    if callable(completeFunc):
-      completeFunc(songID, True)
-    return True
+    return True, text
+
+  def stageSong(self, songID, outputFunction=None):
+    """ First stage of a separately converted song. Downloads it to the staging folder as it is. Returns (True/False for success, youtube-dl's output) """
+    if "/" in songID:
+      raise AssertionError("processSong cannot handle URLs, only youtube video ids")
+    cached = DatabaseHandler.findOtherFormat(songID)
+    if cached: # Kept from when songs were stored with another extension, so it only needs converting
+      os.makedirs(settings["stagingDir"], exist_ok=True)
+      source = os.path.join(settings["stagingDir"], os.path.basename(cached))
+      shutil.move(cached, source)
+      with open(os.path.join(settings["stagingDir"], songID+".info.json"), "w") as file:
+        json.dump({"id": songID, "ext": os.path.splitext(cached)[1][1:], "_filename": source}, file)
+      return True, "Using cached file '{}'".format(cached)
+    exit_code, text = self.downloadSong(songID, outputFolder=settings["stagingDir"], outputFunction=outputFunction, options=self.stageOptions)
+    return exit_code == 0, text
+
+  # For each extension songs can be stored with: youtube-dl's --audio-format for it, the codecs it can hold as they are,
+  #   and the ffmpeg encoder and format used to convert anything else to it
+  formats = {
+    ".mp3": ("mp3", ("mp3",), "libmp3lame", "mp3"),
+    ".m4a": ("m4a", ("mp4a", "aac"), "aac", "ipod"),
+    ".opus": ("opus", ("opus",), "libopus", "opus"),
+    ".ogg": ("vorbis", ("vorbis", "opus"), "libvorbis", "ogg"),
+    ".flac": ("flac", ("flac",), "flac", "flac"),
+  }
+
+  def targetFormat(self):
+    """ The entry in formats for the extension songs are stored with """
+    extension = Settings.application["musicExtension"]
+    if extension not in self.formats:
+      raise ValueError("Can't store songs as '{}', must be one of {}".format(extension, ", ".join(self.formats)))
+    return self.formats[extension]
+
+  def formatSelector(self):
+    """ Youtube-dl's -f for songs. With the "native" policy, streams that can be stored without converting come first """
+    if settings["formatPolicy"] != "native":
+      return "bestaudio/best"
+    return "/".join(["bestaudio[acodec^={}]".format(codec) for codec in self.targetFormat()[1]] + ["bestaudio/best"])
+
+  def transcodeSong(self, songID):
+    """
+    Second stage of a separately converted song. Converts the staged download with ffmpeg into the video folder, then records it as downloaded
+    Returns (True/False for success, ffmpeg's output)
+    """
+    infoFile = os.path.join(settings["stagingDir"], songID+".info.json")
+    with open(infoFile) as file:
+      info = json.load(file)
+    source = info.get("_filename") or os.path.join(settings["stagingDir"], "{}.{}".format(songID, info["ext"]))
+    dest = DatabaseHandler.getVideoFolder(songID)
+    audioFormat, codecs, encoder, container = self.targetFormat()
+    command = [settings["ffmpeg"], "-y", "-nostdin", "-loglevel", "error", "-i", source, "-vn"]
+    if settings["formatPolicy"] == "native" and (info.get("acodec") or "").split(".")[0] in codecs:
+      log.debug("Remuxing Song '{}'".format(songID)) # The audio can go in our container as it is, so it isn't decoded at all
+      command += ["-codec:a", "copy"]
+    else:
+      log.debug("Converting Song '{}'".format(songID))
+      command += ["-codec:a", encoder]
+      if encoder == "libmp3lame":
+        command += ["-q:a", self.audioOptions["--audio-quality"]] # Same as youtube-dl does, 0 is best
+    command += ["-f", container, dest+".tmp"] # Written beside the real file, so a half-converted song never looks downloaded
+
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if process.returncode != 0:
+      if os.path.exists(dest+".tmp"):
+        os.remove(dest+".tmp")
+      return False, process.stdout
+    os.replace(dest+".tmp", dest)
+    if "title" in info: # Not there for a song converted from the cache, which is already in the database
+      DatabaseHandler.addSongFromDict(info)
+    DatabaseHandler.setDownloaded(songID)
+    for filename in (source, infoFile):
+      os.remove(filename)
+    return True, process.stdout
 
-  def downloadSong(self, song, outputFolder="", outputFunction=None, writeJSON=True):
+  def downloadSong(self, song, outputFolder="", outputFunction=None, writeJSON=True, options=None):
     """
     Function to download a song, whether it exists or not already.
     :param song: A url for the song. Youtube-dl on the url should be a song, not a playlist.
     :param outputFolder: A folder to put the video in. If not given, downloads to current directory
     :param outputFunction: If given, should be a callable given three parameters: song (str), Current percentage (float) and download (float str followed by MiB/s or KiB/s). Will be called during execution
     :param writeJSON: If true, will write JSON of request metadata to the video.info.json
-    :return: (Return code, full string of stdout and stderr returned by youtube-dl)
+    :param options: Youtube-dl options to use instead of audioOptions
+    :return: (Return code, the last "outputLines" lines of stdout and stderr returned by youtube-dl)
     """
 
     """
@@ -131,52 +876,70 @@ class VideoProcessor:
       --audio-quality: 0 is best
       --write-info-json: Writes the DASH information for the downloaded video to the filename with .info.json appended
     """
-    audioOptions = self.audioOptions.copy() # Generate a shallow copy of our object's options
+    audioOptions = (self.audioOptions if options is None else options).copy() # Generate a shallow copy of our object's options
     if writeJSON:
       audioOptions["--write-info-json"] = True
     audioOptions.update(settings["youtubeSettings"])
 
-    self.youtubeLock.acquire() # Wait the requisite amount of time
+    if callable(outputFunction):
+      outputFunction = ProgressThrottle(outputFunction, settings["progressRate"])
+
+    self.downloadLimiter.acquire() # Wait the requisite amount of time
     log.debug("Downloading Song '{}'".format(song))
-    obj = subprocess.Popen(
-      [settings["youtube_dl"]] + # Executable
-      self.flattenDict(audioOptions) + #Turn the dict items into a list where key is before value. Bools are special. If false, not added, otherwise only key
-      ["-o", os.path.join(outputFolder, settings["formatString"])] + #Output format and folder
-      ["--", song], #Then add song as input
-      **settings["pipeOptions"], #Add in subprocess options
-      stdout=subprocess.PIPE #Also this for now
-    )
-    
-    outputText = ""
-    for line in obj.stdout:
-      outputText += line
-      match = re.match(r"\[download\]\s+([\d.]+)% of \S+ at\s+([\d.]+\S+)", line) #Matches the download update lines
-      if match:
-        percent, downloadRate = match.group(1, 2)
-        if callable(outputFunction):
-          outputFunction(song, float(percent), downloadRate) #Update this if we have items
-    return obj.wait(), outputText # Wait for process to complete and get return code. Also return the whole output printed to stdout
+    code, text = self.backend.download(song, audioOptions, os.path.join(outputFolder, settings["formatString"]), outputFunction)
+    self.checkRateLimited(self.downloadLimiter, text)
+    return code, text
     
-  def getInfo(self, url, playlist=True):
+  def getInfo(self, url, playlist=True, force_refresh=False):
     """
-    Gets info for a playlist or a song
+    Gets info for a playlist or a song. Results are cached, see InfoCache
     :param url: Either youtube id or url
+    :param force_refresh: If true, always asks youtube rather than using the cache
     :return: If errored, returns string output from process. Otherwise, returns dict returned by youtube-dl
     """
-    try:
-      self.youtubeLock.acquire() # Wait the requisite amount of time
-      log.debug("Getting info for '{}'".format(url))
-      #                                                                                                                                                   -- in case youtube url begins with "-"
-      output = subprocess.check_output([settings["youtube_dl"], "-J", "--flat-playlist", "--yes-playlist" if playlist else ""] + self.flattenDict(settings["youtubeSettings"]) + ["--", url],
-               **settings["pipeOptions"])
-    except subprocess.CalledProcessError as e:
-      return e.output
+    key = ("playlist:" if playlist else "song:") + url
+    if not force_refresh:
+      info = self.infoCache.get(key)
+      if info is not None:
+        log.debug("Using cached info for '{}'".format(url))
+        return info
+    self.metadataLimiter.acquire() # Wait the requisite amount of time
+    log.debug("Getting info for '{}'".format(url))
+    info = self.backend.getInfo(url, playlist)
+    if isinstance(info, str):
+      self.checkRateLimited(self.metadataLimiter, info)
     else:
-      return json.loads(output)
+      self.metadataLimiter.succeed()
+      self.infoCache.put(key, info)
+    return info
+
+  rateLimitPattern = re.compile(r"HTTP Error 429|Too Many Requests")
+
+  def checkRateLimited(self, limiter, output):
+    """ Backs off the limiter if youtube-dl's output says we were rate limited """
+    if self.rateLimitPattern.search(output):
+      limiter.backoff()
+    else:
+      limiter.succeed()
+
+_handler = None
+_handlerLock = threading.Lock()
 
-handler = VideoProcessor()
+def getHandler():
+  """ Returns the shared VideoProcessor, creating it on first use so importing this module doesn't start anything """
+  global _handler
+  if _handler is None:
+    with _handlerLock:
+      if _handler is None:
+        _handler = VideoProcessor()
+  return _handler
 
+def __getattr__(name):
+  # Older code refers to the processor as "DownloadHandler.handler"
+  if name == "handler":
+    return getHandler()
+  raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
 
 if __name__ == "__main__":
-  handler._testPlaylist("https://www.youtube.com/watch?v=YBJhzfvdyKw&list=PLeihsqiyYb0EZSUolQ3QB6CR-TC-j37_p&index=4")
\ No newline at end of file
+  getHandler()._testPlaylist("https://www.youtube.com/watch?v=YBJhzfvdyKw&list=PLeihsqiyYb0EZSUolQ3QB6CR-TC-j37_p&index=4")
\ No newline at end of file
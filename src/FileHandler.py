@@ -1,8 +1,24 @@
-import logging, shutil, os, os.path
+import io, json, logging, shutil, os, os.path, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor, wait as ThreadWait
+from mutagen import File as MutagenFile
 from mutagen.easyid3 import EasyID3, EasyID3KeyError
+from mutagen.easymp4 import EasyMP4Tags
+from mutagen.id3 import ID3NoHeaderError
 
+EasyMP4Tags.RegisterFreeformKey("organization", "organization") # mp4 has no standard tag for it, ogg and flac allow any tag
+
+import Settings
 import DatabaseHandler
 
+Settings.application.updateDefaults({
+  "fileWorkers": 4, # Number of file copies, moves and tag writes done at once
+  # How songs are put in a MusicSet's folders from the video cache. Falls back to "copy" if the filesystem can't do it
+  #   "copy": A full copy with its own tags
+  #   "reflink": Shares the audio with the cached file on copy-on-write filesystems (btrfs, xfs, APFS...), only the tags are stored separately
+  #   "hardlink"/"symlink": Shares the whole file, including the cache's tags. Per-song tags are never written
+  "exportMode": "copy",
+})
+
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
@@ -10,37 +26,274 @@ def copySong(id, folder, filename, title="", artist="", album="", organization="
   # Copy file to dest with file title and same extension
   src  = DatabaseHandler.getVideoFolder(id)
   dest = os.path.join(folder, filename+os.path.splitext(src)[1])
-  os.makedirs(os.path.dirname(dest), exist_ok=True)
-  shutil.copyfile(src, dest)
-  
-  # Then update tags as we can
-  changeTags(dest, {
+  os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+  tags = {
     "title": title,
     "artist": artist,
     "album": album,
     "organization": organization, # Seems like an innocuous place to put the id so we can retrieve it later
-  })
+  }
+
+  mode = Settings.application["exportMode"]
+  if mode in ("hardlink", "symlink") and linkSong(src, dest, mode):
+    return dest
+  if not copyWithTags(src, dest, tags, clone=(mode == "reflink")):
+    # Otherwise copy the file, then update tags as we can
+    shutil.copyfile(src, dest)
+    changeTags(dest, tags)
   
   return dest
+
+def linkSong(src, dest, mode):
+  """ Makes dest a hard or symbolic link to src. Returns False if the filesystem doesn't allow it """
+  try:
+    if os.path.lexists(dest):
+      os.remove(dest)
+    if mode == "hardlink":
+      os.link(src, dest)
+    else:
+      os.symlink(os.path.abspath(src), dest)
+    return True
+  except (OSError, NotImplementedError) as e:
+    log.debug("Could not {} '{}', copying instead: {}".format(mode, dest, e))
+    return False
+
+def isShared(filename):
+  """ True if the file is a link, so writing tags to it would change the cached song and every other link to it """
+  return os.path.islink(filename) or os.stat(filename).st_nlink > 1
+
+def _tagSize(header):
+  """ Size of the ID3v2 tag described by the first 10 bytes of a file, or 0 if there isn't one """
+  if len(header) < 10 or header[:3] != b"ID3":
+    return 0
+  size = 0
+  for byte in header[6:10]: # Size is stored "syncsafe", 7 bits per byte
+    size = (size << 7) | (byte & 0x7f)
+  return 10 + size + (10 if header[5] & 0x10 else 0) # Plus the header, and the footer if there is one
+
+def _copyRange(src, dest, offset, count):
+  """ Copies count bytes from offset in src to the current position in dest, in the kernel if the OS lets us """
+  copyRange = getattr(os, "copy_file_range", None)
+  for attempt in (copyRange, getattr(os, "sendfile", None)):
+    if attempt is None:
+      continue
+    try:
+      while count > 0:
+        if attempt is copyRange:
+          sent = attempt(src.fileno(), dest.fileno(), count, offset)
+        else:
+          sent = attempt(dest.fileno(), src.fileno(), offset, count)
+        if sent == 0:
+          break
+        offset += sent
+        count -= sent
+      return
+    except OSError: # Not supported between these files. Nothing was copied by the failed call, so carry on from here
+      pass
+  src.seek(offset)
+  shutil.copyfileobj(src, dest)
+
+FICLONERANGE = 0x4020940d # Linux ioctl to share a range of one file's blocks with another
+
+def _cloneRange(src, dest, offset, count, destOffset):
+  """ Makes dest share the blocks of src's range instead of copying them. Offsets must be block aligned. Returns False if not supported """
+  try:
+    import fcntl, struct
+    fcntl.ioctl(dest.fileno(), FICLONERANGE, struct.pack("qQQQ", src.fileno(), offset, count, destOffset))
+    return True
+  except (ImportError, OSError):
+    return False
+
+def _blockSize(path):
+  return getattr(os.stat(path), "st_blksize", 4096) or 4096
+
+_reflinkSupport = {} # (source device, destination device) to whether blocks can be shared from one to the other, see _canReflink
+
+def _canReflink(src, destFolder):
+  """
+  Whether a file in destFolder can share blocks with src. Tried once per pair of filesystems, by cloning a small scratch file
+    next to src into destFolder, as that is where the song's copy goes
+  """
+  key = (os.stat(src).st_dev, os.stat(destFolder).st_dev)
+  if key not in _reflinkSupport:
+    folder = os.path.dirname(os.path.abspath(src))
+    blockSize = _blockSize(src)
+    supported = False
+    try:
+      with tempfile.TemporaryFile(dir=folder) as source, tempfile.TemporaryFile(dir=destFolder) as dest:
+        source.write(bytes(blockSize))
+        source.flush()
+        supported = _cloneRange(source, dest, 0, blockSize, 0)
+    except OSError:
+      pass
+    log.debug("Reflinks from '{}' to '{}' are {}".format(folder, destFolder, "supported" if supported else "not supported"))
+    _reflinkSupport[key] = supported
+  return _reflinkSupport[key]
+
+def _renderTag(obj, alignTo=None):
+  """ Returns the bytes of an ID3v2.3 tag. If alignTo is given, the tag is padded to a multiple of it """
+  def render(padding=None):
+    tagData = io.BytesIO()
+    obj.save(tagData, v2_version=3, padding=padding) # Save it in a format recognizable by Windows
+    return tagData.getvalue()
+  if not alignTo:
+    return render()
+  size = len(render(lambda info: 0))
+  return render(lambda info: -size % alignTo)
+
+def _readTag(source):
+  """ Loads the ID3 tag of an open file, or a blank one if it has none """
+  source.seek(0)
+  try:
+    return EasyID3(source)
+  except ID3NoHeaderError:
+    return EasyID3()
+
+def _alignCachedSong(src, blockSize):
+  """
+  Pads the tag of a cached song so its audio starts on a block boundary, which is needed to share the audio blocks
+  Only rewrites the file the first time, returns the new audio start
+  The new file is written under a name of its own, so two threads aligning the same song can't get in each other's way
+  """
+  with open(src, "rb") as source:
+    audioStart = _tagSize(source.read(10))
+    if audioStart and audioStart % blockSize == 0:
+      return audioStart
+    tagData = _renderTag(_readTag(source), blockSize)
+    end = source.seek(0, os.SEEK_END)
+    log.debug("Aligning cached song '{}' for reflinks".format(src))
+    handle, tempName = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(src)+".", dir=os.path.dirname(os.path.abspath(src)))
+    try:
+      with open(handle, "wb") as file:
+        file.write(tagData)
+        file.flush()
+        _copyRange(source, file, audioStart, end - audioStart)
+      os.replace(tempName, src)
+    except BaseException:
+      os.remove(tempName)
+      raise
+  return len(tagData)
+
+def copyWithTags(src, dest, tagsDict, clone=False):
+  """
+  Writes dest as the new ID3 tag followed by the audio from src, in one pass, so the file is only written once
+    rather than copied and then rewritten by mutagen when the tag grows
+  :param clone: If true, tries to share the audio blocks with src rather than copying them, see _cloneRange
+  Returns False without writing anything if the file can't be handled this way (not an mp3, or has an ID3v1 tag to update)
+  """
+  if not _isMP3(src):
+    return False
+  clone = clone and _canReflink(src, os.path.dirname(os.path.abspath(dest))) # Aligning the cached song is only worth rewriting it for if its blocks can then be shared
+  blockSize = _blockSize(src) if clone else None
+  if clone:
+    _alignCachedSong(src, blockSize)
+  with open(src, "rb") as source:
+    audioStart = _tagSize(source.read(10))
+    end = source.seek(0, os.SEEK_END)
+    if end >= 128:
+      source.seek(end - 128)
+      if source.read(3) == b"TAG":
+        return False
+    # Build the new tag in memory, keeping any other frames the source had
+    obj = _readTag(source)
+    for tag in tagsDict:
+      try:
+        obj[tag] = tagsDict[tag] if tagsDict[tag] is not None else ""
+      except EasyID3KeyError:
+        log.error("Could not set tag '{}' for file '{}'!".format(tag, dest))
+    tagData = _renderTag(obj, blockSize)
+    with open(dest, "wb") as file:
+      file.write(tagData)
+      file.flush()
+      if not (clone and _cloneRange(source, file, audioStart, end - audioStart, len(tagData))):
+        _copyRange(source, file, audioStart, end - audioStart)
+  return True
   
 def moveSong(filepath, dest):
-  os.makedirs(os.path.dirname(dest), exist_ok=True)
+  os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
   return shutil.move(filepath, dest)
   
+tagStats = {"written": 0, "skipped": 0} # Number of files changeTags has rewritten, and left alone because nothing changed
+_tagStatsLock = threading.Lock()
+
+def _countTags(key):
+  with _tagStatsLock:
+    tagStats[key] += 1
+
+def getTagStats():
+  """ Returns a copy of tagStats, safe to compare against a later call """
+  with _tagStatsLock:
+    return dict(tagStats)
+
+def _tagValues(value):
+  """ Tag values as the list EasyID3 returns them, so requested and current values can be compared. Empty values count as unset """
+  if value is None:
+    value = []
+  elif isinstance(value, str):
+    value = [value]
+  return [item for item in value if item]
+
+def _isMP3(filename):
+  return os.path.splitext(filename)[1].lower() == ".mp3"
+
+def _openTags(filename):
+  """
+  Loads the tags of a song that isn't an mp3 (mp4/m4a, ogg, opus, flac...), working out the container from the file itself
+  The returned object can be used like an EasyID3, and saved with save()
+  """
+  obj = MutagenFile(filename, easy=True)
+  if obj is None:
+    raise ValueError("'{}' isn't a kind of audio file we can tag".format(filename))
+  if obj.tags is None:
+    obj.add_tags()
+  return obj
+
+def _setTags(obj, tagsDict, filename):
+  """ Sets every tag in tagsDict that differs from what the file already has. Returns True if any did """
+  changed = False
+  for tag in tagsDict:
+    try:
+      if _tagValues(obj.get(tag)) != _tagValues(tagsDict[tag]):
+        obj[tag] = tagsDict[tag] if tagsDict[tag] is not None else ""
+        changed = True
+    except KeyError: # EasyID3KeyError or EasyMP4KeyError, the format has no such tag
+      log.error("Could not set tag '{}' for file '{}'!".format(tag, filename))
+  return changed
+
 def changeTags(filename, tagsDict):
   """
   Will update all tags in the tagsDict. Tags must be of appropriate type. Most tags can be either string or list of strings
+  Files linked to the video cache are left alone, since their tags are shared
+  The file is only rewritten if a tag actually differs from what it already has
+  Returns True if the file was written
   """
+  if isShared(filename):
+    log.debug("Not writing tags to linked file '{}'".format(filename))
+    _countTags("skipped")
+    return False
   
-  with open(filename, "rb+") as file:
-    obj = EasyID3(file)
-    for tag in tagsDict:
-      try:
-        obj[tag] = tagsDict[tag] if tagsDict[tag] is not None else ""
-      except EasyID3KeyError:
-        log.error("Could not set tag '{}' for file '{}'!".format(tag, filename))
-    obj.save(file, v2_version=3) # Save it in a format recognizable by Windows
+  if not _isMP3(filename):
+    obj = _openTags(filename)
+    if not _setTags(obj, tagsDict, filename):
+      _countTags("skipped")
+      return False
+    obj.save()
+  else:
+    with open(filename, "rb+") as file:
+      obj = EasyID3(file)
+      if not _setTags(obj, tagsDict, filename):
+        _countTags("skipped")
+        return False
+      obj.save(file, v2_version=3) # Save it in a format recognizable by Windows
+  _countTags("written")
+  return True
     
+def _splitOrganization(toRet):
+  """ So this should be id and playlist, but we store it in the "organization" tag. Linked files have the cache's tags, which don't have it """
+  organization = toRet.pop("organization")
+  toRet["playlist"], toRet["id"] = organization.split("/", 1) if organization and "/" in organization else (None, None)
+  return toRet
+
 def getTagData(filename):
   """
   Returns a dict of title, artist, album, and id (organization)
@@ -48,15 +301,283 @@ def getTagData(filename):
   Doesn't catch FileNotFoundError s
   """
   toRet = {}
-  with open(filename, "rb") as file:
-    obj = EasyID3(file)
-    for tag in ("title", "artist", "album", "organization"):
+  if _isMP3(filename):
+    with open(filename, "rb") as file:
+      obj = EasyID3(file)
+  else:
+    obj = _openTags(filename)
+  for tag in ("title", "artist", "album", "organization"):
+    try:
+      toRet[tag] = obj[tag][0] # Tags are lists of values, we only ever write one
+    except (KeyError, IndexError):
+      toRet[tag] = None
+  return _splitOrganization(toRet)
+
+# Frame ids of the tags getTagData reads, for ID3v2.2 and for v2.3/v2.4
+_tagFrames = {
+  2: {b"TT2": "title", b"TP1": "artist", b"TAL": "album", b"TPB": "organization"},
+  3: {b"TIT2": "title", b"TPE1": "artist", b"TALB": "album", b"TPUB": "organization"},
+}
+_textEncodings = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+class _UnsupportedTag(Exception):
+  """ The tag uses something _parseTag doesn't handle, so mutagen has to read it """
+
+def _syncsafe(data):
+  size = 0
+  for byte in data:
+    size = (size << 7) | (byte & 0x7f)
+  return size
+
+def _parseTag(file):
+  """
+  Reads title, artist, album and organization straight from the ID3v2 tag at the start of an open file
+  The header is read along with the first few KiB, which holds the whole tag for our songs, and the rest of the tag in one more read if not
+  Raises _UnsupportedTag for anything unusual (no ID3v2 tag, compressed or encrypted frames...)
+  """
+  data = file.read(4096)
+  if len(data) < 10 or data[:3] != b"ID3" or data[3] not in (2, 3, 4):
+    raise _UnsupportedTag()
+  version, flags = data[3], data[5]
+  end = 10 + _syncsafe(data[6:10])
+  if len(data) < end:
+    data += file.read(end - len(data))
+  data = data[10:end]
+  if flags & 0x80 and version < 4: # The whole tag is unsynchronised
+    data = data.replace(b"\xff\x00", b"\xff")
+  position = 0
+  if flags & 0x40 and version == 3: # Skip the extended header
+    position = 4 + int.from_bytes(data[:4], "big")
+  elif flags & 0x40 and version == 4:
+    position = _syncsafe(data[:4])
+  elif flags & 0x40:
+    raise _UnsupportedTag() # v2.2 uses this bit for compression
+
+  frames = _tagFrames[2 if version == 2 else 3]
+  idSize, headerSize = (3, 6) if version == 2 else (4, 10)
+  toRet = dict.fromkeys(frames.values())
+  while position + headerSize <= len(data) and data[position] != 0: # A zero byte starts the padding
+    frameId = data[position:position+idSize]
+    if version == 2:
+      size = int.from_bytes(data[position+3:position+6], "big")
+    elif version == 3:
+      size = int.from_bytes(data[position+4:position+8], "big")
+    else:
+      size = _syncsafe(data[position+4:position+8])
+    start = position + headerSize
+    position = start + size
+    if frameId not in frames:
+      continue
+    frame = data[start:position]
+    if version > 2:
+      frameFlags = data[start-1]
+      if version == 3 and frameFlags & 0xe0 or version == 4 and frameFlags & 0x4c: # Compressed, encrypted or grouped
+        raise _UnsupportedTag()
+      if version == 4 and frameFlags & 0x02: # This frame is unsynchronised
+        frame = frame.replace(b"\xff\x00", b"\xff")
+      if version == 4 and frameFlags & 0x01: # Starts with a data length indicator
+        frame = frame[4:]
+    if not frame or frame[0] >= len(_textEncodings):
+      raise _UnsupportedTag()
+    text = frame[1:].decode(_textEncodings[frame[0]])
+    toRet[frames[frameId]] = text.split("\x00", 1)[0] # Values are separated by nulls, we only ever write one
+  return _splitOrganization(toRet)
+
+def _readTagData(path):
+  if not _isMP3(path):
+    return getTagData(path)
+  try:
+    with open(path, "rb") as file:
+      return _parseTag(file)
+  except (_UnsupportedTag, UnicodeDecodeError):
+    return getTagData(path)
+
+def getTagDataMany(paths):
+  """
+  Reads the tags of many files in parallel on the file pool, like getTagData but only reading the tag at the start of each file
+  Never raises for a single file
+  Returns a dict of path to the getTagData dict for every file that could be read, and a dict of path to exception for every one that couldn't
+  """
+  executor = getExecutor()
+  futures = [(path, executor.submit(_readTagData, path)) for path in paths]
+  results, errors = {}, {}
+  for path, future in futures:
+    try:
+      results[path] = future.result()
+    except Exception as e:
+      errors[path] = e
+  return results, errors
+
+def _readTagIndex(indexFile):
+  try:
+    with open(indexFile) as file:
+      return json.load(file)["files"]
+  except (FileNotFoundError, ValueError, KeyError):
+    return {}
+
+def _writeTagIndex(indexFile, files):
+  with open(indexFile+".tmp", "w") as file:
+    json.dump({"files": files}, file)
+  os.replace(indexFile+".tmp", indexFile)
+
+def _listSongFiles(directory, extension):
+  """ Returns a dict of path relative to directory to [size, mtime] for songs in the directory and the folders directly inside it """
+  files = {}
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      if entry.is_dir():
+        with os.scandir(entry.path) as subEntries: # Songs are only ever one folder deep
+          for subEntry in subEntries:
+            if subEntry.is_file() and os.path.splitext(subEntry.name)[1] == extension:
+              stat = subEntry.stat()
+              files[os.path.join(entry.name, subEntry.name)] = [stat.st_size, stat.st_mtime_ns]
+      elif entry.is_file() and os.path.splitext(entry.name)[1] == extension:
+        stat = entry.stat()
+        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+  return files
+
+def scanTags(directory, indexFile=None):
+  """
+  Returns a dict of path relative to directory to the getTagData dict for every song in a MusicSet's folder
+  If indexFile is given, tags are remembered there along with each file's size and mtime, so that only files
+    that are new or have changed since the last scan are opened. Those are read in parallel on the file pool
+  Files whose tags can't be read are logged and left out
+  """
+  extension = Settings.application["musicExtension"]
+  files = _listSongFiles(directory, extension)
+  index = _readTagIndex(indexFile) if indexFile else {}
+  toRet = {}
+  toRead = []
+  for path, (size, mtime) in files.items():
+    entry = index.get(path)
+    if entry and entry[0] == size and entry[1] == mtime:
+      toRet[path] = entry[2]
+    else:
+      toRead.append(path)
+
+  if toRead:
+    log.debug("Reading tags of {} new or changed files, {} unchanged".format(len(toRead), len(toRet)))
+    results, errors = getTagDataMany([os.path.join(directory, path) for path in toRead])
+    for path in toRead:
+      fullPath = os.path.join(directory, path)
+      if fullPath in results:
+        toRet[path] = results[fullPath]
+      else:
+        log.error("Could not read tags from '{}': {}".format(fullPath, errors[fullPath]))
+
+  if indexFile and (toRead or len(index) != len(toRet)):
+    _writeTagIndex(indexFile, {path: files[path] + [tags] for path, tags in toRet.items()})
+  return toRet
+
+
+class FileOperation:
+  """
+  One change to a file in a MusicSet, either a copy from the video cache or a move of an existing file, followed by writing tags
+  :param source: Path of the existing file without extension, or None to copy the song from the cache
+  :param root: The MusicSet's folder, which folder and source are relative to
+  A copy counts the cached song as one of its paths, so copies of one song to several places run one after another
+  """
+
+  def __init__(self, id, folder, filename, tags, source=None, root=""):
+    self.id = id
+    self.folder = os.path.join(root, folder)
+    self.filename = filename
+    self.tags = tags
+    self.source = source and os.path.join(root, source+Settings.application["musicExtension"])
+    self.dest = os.path.join(self.folder, filename+Settings.application["musicExtension"])
+    self.cached = None if source else DatabaseHandler.getVideoFolder(id)
+
+  def paths(self):
+    return [path for path in (self.source, self.dest, self.cached) if path]
+
+  def run(self):
+    if self.source is None: # If the file doesn't exist in it's proper destination
+      copySong(self.id, self.folder, self.filename, **self.tags)
+    else: # If the file already exists
+      if self.dest != self.source:
+        moveSong(self.source, self.dest)
+      changeTags(self.dest, self.tags)
+
+  def __str__(self):
+    return "{} '{}' to '{}'".format("Copy" if self.source is None else "Move", self.source or self.id, self.dest)
+
+
+_executor = None
+_executorLock = threading.Lock()
+_pathLocks = [threading.Lock() for i in range(64)] # Every path hashes to one of these, so operations on a path never overlap
+
+def getExecutor():
+  global _executor
+  with _executorLock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=Settings.application["fileWorkers"])
+  return _executor
+
+def _runChain(chain, progress):
+  """ Runs operations that share paths one after another, holding the locks for every path they touch """
+  locks = sorted({hash(os.path.normcase(os.path.abspath(path))) % len(_pathLocks) for op in chain for path in op.paths()})
+  for index in locks: # Always taken in the same order, so two chains can't deadlock
+    _pathLocks[index].acquire()
+  try:
+    for op in chain:
       try:
-        toRet[tag] = obj[tag]
-      except KeyError:
-        toRet[tag] = None
-    # So this should be id and playlist, but we store it in the "organization" tag
-    toRet["playlist"], toRet["id"] = toRet["organization"].split("/")
-    del toRet["organization"]
-    
-    return toRet
\ No newline at end of file
+        op.run()
+      except Exception as e:
+        log.error("File operation failed: {} ({})".format(op, e))
+        progress(op, e)
+      else:
+        progress(op, None)
+  finally:
+    for index in locks:
+      _pathLocks[index].release()
+
+def runOperations(operations, progressFunction=None):
+  """
+  Runs a list of FileOperations on the file worker pool, and waits for them to finish
+  Operations that touch the same path run in the order given, everything else runs in parallel
+  :param progressFunction: If given, called after each operation with (operations done, total operations, operation)
+  :return: List of (operation, exception) for every operation that failed
+  """
+  # Group operations into chains that share a path, so each chain can run by itself
+  chainOf = {} # Path to the chain containing it
+  chains = []
+  order = {id(op): i for i, op in enumerate(operations)}
+  for op in operations:
+    keys = [os.path.normcase(os.path.abspath(path)) for path in op.paths()]
+    found = []
+    for key in keys:
+      chain = chainOf.get(key)
+      if chain is not None and not any(chain is other for other in found):
+        found.append(chain)
+    if not found:
+      chain = []
+      chains.append(chain)
+    else: # Merge every chain this operation connects into the first one, keeping the original order
+      chain = found[0]
+      for other in found[1:]:
+        chain.extend(other)
+        chain.sort(key=lambda op: order[id(op)])
+        chains.remove(other)
+        for path, owner in chainOf.items():
+          if owner is other:
+            chainOf[path] = chain
+    chain.append(op)
+    for key in keys:
+      chainOf[key] = chain
+
+  done = [0]
+  failures = []
+  doneLock = threading.Lock()
+  def progress(op, error):
+    with doneLock:
+      done[0] += 1
+      if error is not None:
+        failures.append((op, error))
+      count = done[0]
+    if callable(progressFunction):
+      progressFunction(count, len(operations), op)
+
+  executor = getExecutor()
+  ThreadWait([executor.submit(_runChain, chain, progress) for chain in chains])
+  return failures
+
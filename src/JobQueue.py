@@ -0,0 +1,111 @@
+# A record of every song waiting to be downloaded, kept on disk so that work survives the program closing or crashing
+import logging, os, sqlite3, threading
+from time import time
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+# States a job can be in
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+def unfinishedIDs(filename):
+  """
+  Returns the set of song ids with a queued or running job in a job queue file, without needing a JobQueue for it
+  Returns None if the file exists but can't be read
+  """
+  if not os.path.exists(filename):
+    return set()
+  try:
+    connection = sqlite3.connect(filename)
+    try:
+      return {row[0] for row in connection.execute("SELECT id FROM jobs WHERE state IN (?, ?)", (QUEUED, RUNNING))}
+    finally:
+      connection.close()
+  except sqlite3.Error as e:
+    log.warning("Could not read job queue '{}': {}".format(filename, e))
+    return None
+
+class JobQueue:
+  """
+  Stores one row per song in an SQLite database, with its state and the number of times it has been tried
+  Every change is committed straight away, so after a crash the queue says exactly which songs were waiting or in flight
+  Finished jobs are only kept until the next start, and failed ones for keepFailed seconds
+  """
+
+  columns = ("id", "playlist", "state", "attempts", "queuedAt", "updatedAt", "error")
+
+  def __init__(self, filename, keepFailed=7*24*3600):
+    self.filename = filename
+    self.lock = threading.Lock()
+    # Jobs change state on worker threads, so the connection is shared and guarded by our own lock
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    with self.connection:
+      self.connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, playlist TEXT, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+        " queuedAt REAL, updatedAt REAL, error TEXT)"
+      )
+      self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+      self.connection.execute("DELETE FROM jobs WHERE state = ? OR (state = ? AND updatedAt < ?)", (DONE, FAILED, time()-keepFailed))
+
+  def _select(self, where="", args=()):
+    with self.lock:
+      rows = self.connection.execute("SELECT {} FROM jobs {} ORDER BY queuedAt".format(", ".join(self.columns), where), args).fetchall()
+    return [dict(zip(self.columns, row)) for row in rows]
+
+  def add(self, id, playlist=None):
+    """
+    Queues a song because it was asked for. A song that was queued before is queued again with its attempt count reset,
+      so a song that failed before gets all its attempts again. A running job carries on running. See retry for trying again after failing
+    """
+    now = time()
+    with self.lock, self.connection:
+      self.connection.execute(
+        "INSERT INTO jobs (id, playlist, state, attempts, queuedAt, updatedAt) VALUES (?, ?, ?, 0, ?, ?)"
+        " ON CONFLICT(id) DO UPDATE SET state = CASE WHEN state = ? THEN state ELSE excluded.state END, playlist = coalesce(excluded.playlist, playlist),"
+        " attempts = 0, updatedAt = excluded.updatedAt, error = NULL",
+        (id, playlist, QUEUED, now, now, RUNNING)
+      )
+
+  def retry(self, id, error=None):
+    """ Queues a job again after a failed attempt, keeping its attempt count so it is eventually given up on """
+    with self.lock, self.connection:
+      self.connection.execute("UPDATE jobs SET state = ?, updatedAt = ?, error = ? WHERE id = ?", (QUEUED, time(), error, id))
+
+  def start(self, id):
+    """ Marks a job as being worked on, counting it as another attempt """
+    with self.lock, self.connection:
+      self.connection.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updatedAt = ? WHERE id = ?", (RUNNING, time(), id))
+
+  def finish(self, id, success, error=None):
+    with self.lock, self.connection:
+      self.connection.execute("UPDATE jobs SET state = ?, updatedAt = ?, error = ? WHERE id = ?", (DONE if success else FAILED, time(), error, id))
+
+  def remove(self, id):
+    """ Forgets a job, for songs that are no longer wanted """
+    with self.lock, self.connection:
+      self.connection.execute("DELETE FROM jobs WHERE id = ?", (id,))
+
+  def get(self, id):
+    """ Returns the job for a song as a dict, or None if it isn't in the queue """
+    jobs = self._select("WHERE id = ?", (id,))
+    return jobs[0] if jobs else None
+
+  def unfinished(self):
+    """ Jobs that were queued or running when the program last stopped, oldest first """
+    return self._select("WHERE state IN (?, ?)", (QUEUED, RUNNING))
+
+  def failed(self):
+    return self._select("WHERE state = ?", (FAILED,))
+
+  def counts(self):
+    """ Returns a dict of state to number of jobs in it """
+    with self.lock:
+      return dict(self.connection.execute("SELECT state, count(*) FROM jobs GROUP BY state"))
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
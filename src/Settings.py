@@ -2,20 +2,35 @@
 # Maybe like syntactic override for having a dict to . notification. So could do like
 # Settings.log["test"] or Settings.log.test
 
+from itertools import count
+
 class NoDefaultWarning(Warning):
   pass
 
+_versions = count(1) # Every change to any SettingsDict takes the next number, so a higher number always means a later change
+_latest = 0 # The version of the last change to any SettingsDict
+
 class SettingsDict(dict):
   """
   Each setting will be 2-layered, with a real value, and then a set of defaults backing it in 2 separate dicts
   Because you can create "instances" of settings which use the settings as defaults, you can create tiered settings,
     where changes to parents are propogated down the line to lower levels.
+
+  Each layer keeps a version, the number of its last change. A flattened dict of every layer is cached and only rebuilt
+    when some layer it was built from has changed since, so lookups, iteration and copies don't walk all the layers
+    If no settings have changed anywhere since the cache was last checked, it isn't even checked
+  NOTE: A plain dict used as the bottom layer can't be watched, so it should only be changed through updateDefaults
   """
-  
+
+  _internal = frozenset(("_defaults", "_version", "_flat", "_flatVersion", "_flatChecked")) # Attributes that are never settings
   
   def __init__(self, *args, **kwargs):
-    super().__init__(*args, **kwargs)
+    self._version = next(_versions)
+    self._flat = None # All layers flattened into one dict, or None if not built yet
+    self._flatVersion = 0 # The newest version of any layer when _flat was built
+    self._flatChecked = 0 # The latest change anywhere when _flat was last known to be current
     self._defaults = {}
+    super().__init__(*args, **kwargs)
   
   def __getattr__(self, name):
     try:
@@ -24,47 +39,116 @@ class SettingsDict(dict):
       raise AttributeError from None
       
   def __setattr__(self, name, value):
-    if name != "_defaults" and name in self:
+    if name not in self._internal and name in self:
       self[name] = value
     else:
       super().__setattr__(name, value)
+      if name == "_defaults": # Changing what we inherit from changes our settings
+        self._changed()
+
+  def _changed(self):
+    global _latest
+    version = next(_versions)
+    super().__setattr__("_version", version)
+    _latest = version
+
+  def _newestVersion(self):
+    """ Returns the version of the most recently changed layer, this one included """
+    version = self._version
+    layer = self._defaults
+    while isinstance(layer, SettingsDict):
+      if layer._version > version:
+        version = layer._version
+      layer = layer._defaults
+    return version
+
+  def _view(self):
+    """ Returns a dict of every setting with its value through all layers. It must not be modified """
+    if self._flatChecked == _latest and self._flat is not None:
+      return self._flat
+    checked = _latest # Read first, so a change made while we look counts as unchecked
+    version = self._newestVersion()
+    if self._flat is None or version != self._flatVersion:
+      # Layers that have never been flattened themselves are merged straight into ours, rather than each keeping a view
+      layers = [self]
+      base = self._defaults
+      while isinstance(base, SettingsDict) and base._flat is None:
+        layers.append(base)
+        base = base._defaults
+      flat = dict(base._view() if isinstance(base, SettingsDict) else base)
+      for layer in reversed(layers):
+        flat.update(dict.items(layer))
+      # Replaced rather than changed in place, so anyone iterating an older view isn't affected
+      super().__setattr__("_flat", flat)
+      super().__setattr__("_flatVersion", version)
+    super().__setattr__("_flatChecked", checked)
+    return self._flat
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self._changed()
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self._changed()
+
+  def __ior__(self, other):
+    self.update(other)
+    return self
+
+  def update(self, *args, **kwargs):
+    super().update(*args, **kwargs)
+    self._changed()
+
+  def setdefault(self, key, default=None):
+    if not super().__contains__(key):
+      self[key] = default
+    return super().__getitem__(key)
+
+  def pop(self, *args):
+    value = super().pop(*args)
+    self._changed()
+    return value
+
+  def popitem(self):
+    item = super().popitem()
+    self._changed()
+    return item
+
+  def clear(self):
+    super().clear()
+    self._changed()
       
   def __len__(self):
     """ Size of dict is sum of all elements in dict and defaults """
-    return len(set(self) | set(self._defaults))
+    return len(self._view())
     
   def __missing__(self, key):
     """ If key wasn't in main dict, return the default """
-    return self._defaults[key]
+    flat = self._flat
+    if flat is None or self._flatChecked != _latest:
+      flat = self._view()
+    return flat[key]
     
   def __iter__(self):
-    return iter(set(super().__iter__()) | set(self._defaults))
+    return iter(self._view())
     
   def __str__(self):
-    temp = dict(self._defaults)
-    for item in self: # Can't figure out what mechanism "update" uses, so this will do
-      temp[item] = self[item]
-    return str(temp)
+    return str(self._view())
 
   def __repr__(self):
-    temp = dict(self._defaults)
-    for item in self: # Can't figure out what mechanism "update" uses, so this will do
-      temp[item] = self[item]
-    return repr(temp)
+    return repr(self._view())
     
   def __contains__(self, key):
     """ Returns true if in defaults or overlay dict
       NOTE: setattr depends on this, and will set a value in the main dict if a default exists
             This results in slightly different behaviour if using .notation or [notation] as [notation] will allow settings items without a default
     """
-    return super().__contains__(key) or key in self._defaults
+    return key in self._view()
   
   def copy(self):
     """ Creates a dict-copy of this object """
-    toRet = {}
-    for key in self:
-      toRet[key] = self[key]
-    return toRet
+    return dict(self._view())
   
   def createInstance(self, setDefaults = True):
     """
@@ -95,6 +179,7 @@ class SettingsDict(dict):
     if updateDict is None: # If not specified as dict, use kwargs. If these are empty, do nothing
       updateDict = updates
     self._defaults.update(updateDict)
+    self._changed() # In case the defaults are a plain dict, which doesn't keep a version
     
   def getDefault(self, key):
     return self._defaults[key]
@@ -102,9 +187,9 @@ class SettingsDict(dict):
   def getOverrides(self):
     return super().copy() # Returns a copy of just the elements in self
     
-  def isDefault(key):
+  def isDefault(self, key):
     """ Returns true if the key is in the defaults and not in the top layer, false otherwise """
-    return not super.__contains__(key) and key in self._defaults
+    return not super().__contains__(key) and key in self._defaults
     
   # NOTE: Keys should always be cleared rather than set to the default value, as the default is global and could be changed.
   def resetKey(self, key):
@@ -0,0 +1,280 @@
+# Storage backends for the song database. DatabaseHandler keeps the working copy of every song in memory,
+#   and tells the store whenever a single song changes so that saving doesn't need to rewrite the whole library
+import json, logging, os, shutil, sqlite3, threading
+from time import time
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+class JSONStore:
+  """
+  The original storage format, a single json snapshot of every song, plus an append-only journal of changes
+  Each change is one json line in the journal, so persisting an update costs O(1) instead of rewriting the snapshot.
+  On load the journal is replayed on top of the snapshot, and once the journal gets big or old enough it is
+    folded into a new snapshot in the background
+  """
+
+  def __init__(self, filename, syncEvery=50, compactSize=4*1024*1024, compactAge=600):
+    """
+    filename: Path to the json snapshot. The journal is stored next to it
+    syncEvery: Number of journal entries written between each fsync
+    compactSize: Journal size in bytes after which it is folded into the snapshot
+    compactAge: Seconds after the last snapshot after which a non-empty journal is folded into the snapshot
+    """
+    self.filename = filename
+    self.journalFile = filename+".journal"
+    self.compactingFile = filename+".journal.compacting" # A journal that is being folded into a new snapshot
+    self.syncEvery = syncEvery
+    self.compactSize = compactSize
+    self.compactAge = compactAge
+    self.lock = threading.RLock()
+    self.videos = {}
+    self.journal = None
+    self.unsynced = 0 # Entries written since the last fsync
+    self.lastCompact = time()
+    self.compactThread = None
+
+  @staticmethod
+  def replay(filename, videos):
+    """ Applies every entry in a journal file to the videos dict. A partially written last line is ignored """
+    try:
+      with open(filename) as file:
+        for line in file:
+          try:
+            entry = json.loads(line)
+          except ValueError: # Crashed while writing this line
+            log.warning("Ignoring damaged journal entry in '{}'".format(filename))
+            continue
+          if entry["op"] == "put":
+            videos[entry["id"]] = entry["song"]
+          elif entry["op"] == "delete":
+            videos.pop(entry["id"], None)
+          elif entry["op"] == "clear":
+            videos.clear()
+    except FileNotFoundError:
+      pass
+
+  def load(self):
+    """ Returns a dict of song id to song dict. The returned dict is the one that will be saved on flush """
+    with self.lock:
+      self.waitCompact()
+      try:
+        with open(self.filename) as file:
+          self.videos = json.load(file).get("videos", {})
+        self.lastCompact = os.path.getmtime(self.filename)
+        log.debug("Database file found and loaded")
+      except FileNotFoundError: # If there's no file yet, just ignore this
+        log.debug("Database file not found, storing in RAM")
+        self.videos = {}
+      # A compacting journal is only left over if we crashed mid-compaction. Replaying twice is harmless since puts store whole songs
+      for filename in (self.compactingFile, self.journalFile):
+        self.replay(filename, self.videos)
+      self.maybeCompact()
+      return self.videos
+
+  def write(self, entry):
+    with self.lock:
+      if self.journal is None:
+        self.journal = open(self.journalFile, "a")
+      self.journal.write(json.dumps(entry)+"\n")
+      self.unsynced += 1
+      if self.unsynced >= self.syncEvery:
+        self.sync()
+      self.maybeCompact()
+
+  def sync(self):
+    with self.lock:
+      if self.journal is not None and self.unsynced:
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.unsynced = 0
+
+  def put(self, id, songDict):
+    with self.lock:
+      self.videos[id] = songDict
+      self.write({"op": "put", "id": id, "song": songDict})
+
+  def delete(self, id):
+    with self.lock:
+      self.videos.pop(id, None)
+      self.write({"op": "delete", "id": id})
+
+  def clear(self):
+    with self.lock:
+      self.videos.clear()
+      self.write({"op": "clear"})
+
+  def flush(self):
+    """ Makes sure every change so far is on disk """
+    self.sync()
+
+  def maybeCompact(self):
+    """ Starts a background compaction if the journal has passed the size or age threshold """
+    with self.lock:
+      if self.compactThread is not None and self.compactThread.is_alive():
+        return
+      try:
+        size = os.path.getsize(self.journalFile)
+      except FileNotFoundError:
+        return
+      if size >= self.compactSize or (size and time() - self.lastCompact >= self.compactAge):
+        self.compactThread = threading.Thread(target=self.compact, args=(self.rotate(),), daemon=True)
+        self.compactThread.start()
+
+  def rotate(self):
+    """ Moves the current journal aside so new changes go to a fresh one, returning a copy of the songs to snapshot """
+    with self.lock:
+      self.sync()
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
+      if os.path.exists(self.journalFile):
+        if os.path.exists(self.compactingFile): # A previous compaction never finished, keep both sets of changes
+          with open(self.journalFile) as new, open(self.compactingFile, "a") as old:
+            shutil.copyfileobj(new, old)
+          os.remove(self.journalFile)
+        else:
+          os.replace(self.journalFile, self.compactingFile)
+      self.lastCompact = time()
+      return {id: dict(songDict) for id, songDict in self.videos.items()}
+
+  def compact(self, videos):
+    """ Writes a new snapshot, then discards the journal it replaces. Runs without holding the lock """
+    log.debug("Compacting database journal into snapshot")
+    tempFile = self.filename+".tmp"
+    with open(tempFile, "w") as file:
+      json.dump({"videos": videos}, file)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(tempFile, self.filename)
+    os.remove(self.compactingFile)
+
+  def waitCompact(self):
+    thread = self.compactThread
+    if thread is not None:
+      thread.join()
+
+  def close(self):
+    """ Folds any remaining journal into the snapshot so the next load doesn't need to replay it """
+    with self.lock:
+      self.waitCompact()
+      if self.journal is not None or os.path.exists(self.journalFile):
+        self.compact(self.rotate())
+
+
+class SQLiteStore:
+  """
+  Stores one row per song in an SQLite database in WAL mode
+  Changed songs are queued with "put" and upserted together on flush, so saving costs O(changed songs) rather than O(library)
+  """
+
+  # Columns that get their own field in the table. Anything else in a song dict goes in the "extra" json column
+  columns = ("downloadedAt", "title", "author", "length", "songTitle", "songArtist", "songAlbum")
+
+  def __init__(self, filename, batchSize=500):
+    """
+    filename: Path to the database file. Created if it doesn't exist
+    batchSize: Number of queued songs after which a flush happens automatically
+    """
+    self.filename = filename
+    self.batchSize = batchSize
+    self.lock = threading.RLock()
+    self.pending = {} # Dict of id to song dict (or None for deletion) that haven't been written yet
+    # Downloads finish on worker threads, so the connection is shared and guarded by our own lock
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL") # Safe with WAL, and doesn't fsync on every commit
+    with self.connection:
+      self.connection.execute(
+        "CREATE TABLE IF NOT EXISTS songs (id TEXT PRIMARY KEY, downloadedAt INTEGER, title TEXT, author TEXT, length REAL,"
+        " songTitle TEXT, songArtist TEXT, songAlbum TEXT, extra TEXT)"
+      )
+      for column in ("downloadedAt", "title", "songArtist"):
+        self.connection.execute("CREATE INDEX IF NOT EXISTS songs_{0} ON songs ({0})".format(column))
+
+  def isEmpty(self):
+    with self.lock:
+      return self.connection.execute("SELECT 1 FROM songs LIMIT 1").fetchone() is None
+
+  @classmethod
+  def toRow(cls, id, songDict):
+    extra = {key: value for key, value in songDict.items() if key not in cls.columns}
+    return (id,) + tuple(songDict.get(key) for key in cls.columns) + (json.dumps(extra) if extra else None,)
+
+  @classmethod
+  def fromRow(cls, row):
+    if row[2] is None: # No title means this is just a dummy entry for a file we found
+      songDict = {"downloadedAt": row[1]}
+    else:
+      songDict = dict(zip(cls.columns, row[1:-1]))
+    if row[-1]:
+      songDict.update(json.loads(row[-1]))
+    return songDict
+
+  def load(self):
+    with self.lock:
+      rows = self.connection.execute("SELECT id, {}, extra FROM songs".format(", ".join(self.columns)))
+      videos = {row[0]: self.fromRow(row) for row in rows}
+    log.debug("Loaded {} songs from database".format(len(videos)))
+    return videos
+
+  def get(self, id):
+    """ Reads a single song straight from the database, or None if it doesn't exist """
+    with self.lock:
+      if id in self.pending:
+        return self.pending[id]
+      row = self.connection.execute("SELECT id, {}, extra FROM songs WHERE id = ?".format(", ".join(self.columns)), (id,)).fetchone()
+    return row and self.fromRow(row)
+
+  def put(self, id, songDict):
+    """ Queues a song to be upserted. The dict is read when flushed, so later changes to it are also saved """
+    with self.lock:
+      self.pending[id] = songDict
+      if len(self.pending) >= self.batchSize:
+        self.flush()
+
+  def delete(self, id):
+    with self.lock:
+      self.pending[id] = None
+
+  def clear(self):
+    with self.lock:
+      self.pending.clear()
+      with self.connection:
+        self.connection.execute("DELETE FROM songs")
+
+  def flush(self):
+    with self.lock:
+      if not self.pending:
+        return
+      upserts = [self.toRow(id, songDict) for id, songDict in self.pending.items() if songDict is not None]
+      deletes = [(id,) for id, songDict in self.pending.items() if songDict is None]
+      with self.connection: # One transaction for the whole batch
+        self.connection.executemany("INSERT OR REPLACE INTO songs VALUES ({})".format(", ".join("?"*(len(self.columns)+2))), upserts)
+        self.connection.executemany("DELETE FROM songs WHERE id = ?", deletes)
+      log.debug("Wrote {} songs to database, deleted {}".format(len(upserts), len(deletes)))
+      self.pending.clear()
+
+  def close(self):
+    with self.lock:
+      self.flush()
+      self.connection.close()
+
+
+def migrateJSON(jsonFile, store):
+  """
+  One-time import of the old json database into a new store. The json file is renamed afterwards so this only happens once
+  Returns the number of songs migrated
+  """
+  if not os.path.exists(jsonFile):
+    return 0
+  source = JSONStore(jsonFile)
+  videos = source.load()
+  log.info("Migrating {} songs from '{}'".format(len(videos), jsonFile))
+  for id, songDict in videos.items():
+    store.put(id, songDict)
+  store.flush()
+  for filename in (jsonFile, source.journalFile, source.compactingFile):
+    if os.path.exists(filename):
+      os.replace(filename, filename+".migrated")
+  return len(videos)
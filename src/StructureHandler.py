@@ -1,5 +1,8 @@
 # This defines the structure and functionality for the levels of music management
 import json, logging, os, re, threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import Settings
 import FileHandler
 import DatabaseHandler
@@ -19,26 +22,46 @@ class MusicSet:
     self.songSettings = songSettings.createInstance() # Create a new instance for default settings in this musicset
     
     self.name = None
+    self.directory = None # Folder the set's songs are kept in, which their folder settings are relative to. Set on initialize
     
+    self.songTable = SongTable(self.songSettings) # Storage for the songs in songsExpected
     self.songsExpected = []
+    self.actualTable = SongTable(self.songSettings)
+    self.songsActual = [] # Songs found in the output folder on initialize, from their tags
+    self.actualByOrganization = {} # Organization string (see Song.getOrganization) to the song in songsActual with it
+    # Indexes of songsExpected, kept up to date by addSong and indexPath
+    self.songsByOrganization = {} # Organization string (see Song.getOrganization) to song
+    self.songsById = {} # Song id to list of songs with that id (one per playlist it is in)
+    self.songsByPath = {} # Destination path (folder and filename) to song
+    self.songsByPlaylist = {} # Playlist id (or None) to list of songs in it
     
     self.sources = {} # Dict of playlist id to playlist objects that we draw songs from
     
-    self.changeSetLock = threading.Lock() # Mutex so we don't try to concurrently modify files
-    self.changeSet = [] # A list of two-tuples, [0] is either file location of song or None [1] is 3-tuple of song id, playlist id, desired settings
+    self.changeSetLock = threading.RLock() # Mutex so we don't try to concurrently modify files
+    self.changeSet = OrderedDict() # Song organization to two-tuple, [0] is either file location of song or None [1] is the song object. See queueChange
     self.downloadSet = [] # List of ids that need to be downloaded
     
     self.rules = [] # List of rules that apply to this music set.
+    self.pipelines = {} # Playlist id (or None) to (rules, RulePipeline) for its songs, see getPipeline
     
     self.ignored = [] # List of ids that we ignore from downloading. If already downloaded, won't be modified.
-    
+
+    # Songs whose information in the database changed since their rules last ran, see refresh
+    self.dirtyLock = threading.Lock()
+    self.dirtySongs = set()
+    DatabaseHandler.addListener(self.songInfoChanged) # Only weakly held, but close stops it straight away
+    
+  def close(self):
+    """ Stops the set listening for changes to the database. For a set that is no longer used """
+    DatabaseHandler.removeListener(self.songInfoChanged)
+
   def initialize(self, fileDict):
     """ 
     Function to initialize the music set from a dict in a file
     
     The file should contain a dict with the following:
       "name": Name of music set, also used as the file name
-      "sources": list of playlist objects - a dict of "id", "title", "folder"
+      "sources": list of playlist objects - a dict of "id", "title", "folder", and optionally "fingerprint"
       "songs": list of song objects - a dict of see Song "initialize" for obj
         
     """
@@ -56,49 +79,49 @@ class MusicSet:
       # If there is a playlist, we want to add in the settings from the playlist for each song
       if songObj.playlist in self.sources:
         songObj.setPlaylist(self.sources[songObj.playlist])
-      self.songsExpected.append(songObj)
+      if self.addSong(songObj) is not songObj: # Listed twice in the file
+        songObj.release()
       
     log.debug("Gathering data from downloaded files")
     # Then get all information on files currently downloaded
     directory = os.path.join(Settings.application.outputDir, self.name)
     if not os.path.isabs(directory):
       directory = os.path.join(".", directory)
+    self.directory = directory
+    self.actualTable = SongTable(self.songSettings)
+    self.songsActual = [] # TODO: Just do an update of this so actual matches expected after initialization
+    self.actualByOrganization = {}
     if os.path.isdir(directory):
-      songsActual = [] # TODO: Just do an update of this so actual matches expected after initialization
-      for baseDir, dirs, files in os.walk(directory):
-        for file in files:
-          if os.path.splitext(file)[1] == Settings.application["musicExtension"]:
-            newSong = Song(self)
-            newSong.settings["filename"] = file
-            if baseDir != directory: # If we aren't in the base directory
-              newSong.settings["folder"] = os.path.basename(baseDir) # Assume only one folder deep, get the last element of this
-            
-            metadata = FileHandler.getTagData(os.path.join(baseDir, file))
-            for key, value in metadata.items():
-              if key == "id" and value:
-                newSong.id = value
-              if key == "playlist" and value:
-                if value in self.sources:
-                  newSong.setPlaylist(self.sources[playlist])
-              else:
-                if value is not None:
-                  newSong.settings[key] = value
-             
-            songsActual.append(newSong)
-          if baseDir != directory: # Assume tree only one deep, if not going through playlist folders, clear all other dirs.
-            dirs.clear()
+      # Tags are cached next to the folder, so only files that changed since the last start are opened
+      for path, metadata in FileHandler.scanTags(directory, directory+".tags.json").items():
+        newSong = Song(self, table=self.actualTable)
+        folder, file = os.path.split(path)
+        newSong.settings["folder"] = folder
+        newSong.settings["filename"] = os.path.splitext(file)[0]
+        if metadata["id"]:
+          newSong.id = metadata["id"]
+        if metadata["playlist"] in self.sources:
+          newSong.setPlaylist(self.sources[metadata["playlist"]])
+        else:
+          newSong.playlist = metadata["playlist"]
+        for key in ("title", "artist", "album"):
+          if metadata[key] is not None:
+            newSong.settings[key] = metadata[key]
+        self.songsActual.append(newSong)
+        if newSong.id:
+          self.actualByOrganization[newSong.getOrganization()] = newSong
         
     else:
       log.warning("In MusicSet initializer, output directory doesn't exist!")
       
     
     
-    log.info("Loaded information on \n  {} playlists\n  {} song information".format(len(self.sources), len(self.songsExpected)))
+    log.info("Loaded information on \n  {} playlists\n  {} song information\n  {} song files".format(len(self.sources), len(self.songsExpected), len(self.songsActual)))
     
   def save(self):
     toSave = {"name": self.name, "sources": [], "songs": []}
     for source in self.sources.values():
-      toSave["sources"].append({"id": source.id, "title": source.title, "folder": source.folder})
+      toSave["sources"].append({"id": source.id, "title": source.title, "folder": source.folder, "fingerprint": source.fingerprint})
     for song in self.songsExpected:
       toSave["songs"].append(song.save())
     return toSave
@@ -107,31 +130,135 @@ class MusicSet:
     with open(filename, "w") as file:
       json.dump(self.save(), file)
     
+  def getPipeline(self, playlist):
+    """
+    The compiled rules for songs of a playlist (id, or None), the set's rules followed by the playlist's
+    Rules are treated as unchanging once made, so the pipeline is only looked up again when the lists of rules change
+    """
+    rules = tuple(self.rules)
+    if playlist and playlist in self.sources:
+      rules += tuple(self.sources[playlist].rules)
+    cached = self.pipelines.get(playlist)
+    if cached is None or cached[0] != rules:
+      cached = self.pipelines[playlist] = (rules, RulePipeline.forRules(rules))
+    return cached[1]
+
   def runRules(self, song, addToChangeSet=False):
     """ Runs all rules, generates expected folder, filename, and mp3 id3 info. Should be run after initialization completed """
     originalSettings = song.settings.copy() # Creat a dumb dict of the settings
     songInfo = DatabaseHandler.getSong(song.id)
-    for rule in self.rules:
-      rule.run(song, songInfo)
-    if song.playlist and song.playlist in self.sources:
-      for rule in self.sources[song.playlist].rules:
-        rule.run(song, songInfo)
-        
+    pipeline = self.getPipeline(song.playlist)
+    song.defaults.resetAll() # Replaced, so a setting the rules no longer give doesn't linger from the song's old information
+    song.defaults.update(pipeline.evaluate(songInfo))
+    song.ruleKey = (pipeline, pipeline.key(songInfo))
+    self.finishRules(song, originalSettings, addToChangeSet)
+
+  def finishRules(self, song, originalSettings, addToChangeSet):
+    """ Checks and cleans up a song's settings after its rules have run, and queues a change if they differ from originalSettings """
     # After going through all rules, ensure we have a filename and make sure filename and folder are allowable
     if not song.settings["filename"]:
       raise RuntimeError("Song doesn't have a filename property")
     for key in ("filename", "folder"):
-      song.settings[key] = re.sub(r'[/\:<>?*"|]', "", song.settings[key])
+      value = _unsafeCharacters.sub("", song.settings[key])
+      if value != song.settings[key]:
+        # Cleaned in the layer it came from, so that settings from rules and playlists aren't pinned as overrides on the song
+        (song.defaults if song.settings.isDefault(key) else song.settings)[key] = value
         
     if addToChangeSet:
       newSettings = song.settings.copy()
-      if newSettings != originalSettings: # I don't want to rewrite __equals__, so we'll just copy again
+      if originalSettings["filename"] is None:
+        # The first time rules run for a song, such as after loading, there is nothing to compare to but its file as found on disk
+        actual = self.actualByOrganization.get(song.getOrganization())
+        if actual is not None:
+          origPath = os.path.join(actual.settings["folder"], actual.settings["filename"])
+          if origPath != os.path.join(newSettings["folder"], newSettings["filename"]) or \
+              any(actual.settings[key] != newSettings[key] for key in ("title", "artist", "album")):
+            self.queueChange(origPath, song)
+      elif newSettings != originalSettings: # I don't want to rewrite __equals__, so we'll just copy again
         origPath = os.path.join(originalSettings["folder"], originalSettings["filename"])
-        self.changeSet.append((origPath, song)) # Add a tuple of settings as they are now
+        self.queueChange(origPath, song) # Add a tuple of settings as they are now
+    self.indexPath(song)
     
-  def runRulesAllSongs(self):
-    for song in self.songsExpected:
-      runRules(song, addToChangeSet=True)
+  def runRulesAllSongs(self, processes=None):
+    """
+    Runs the rules on every song, queueing changes for any that moved
+    :param processes: If given, new songs are evaluated across this many processes when there are enough of them to be worth it
+    """
+    self.runRulesFor(self.songsExpected, processes)
+
+  def runRulesFor(self, songs, processes=None, onlyChanged=False):
+    """
+    Runs the rules on a list of songs, queueing changes for any that moved
+    Songs are grouped by the rules that apply to them, and the rules are only evaluated for songs with information
+      they haven't seen before, see RulePipeline
+    :param onlyChanged: If true, songs whose rules and the song information they read are the same as last time are skipped
+    :return: Number of songs whose rules were run
+    """
+    batches = {} # Playlist to list of (song, song info)
+    for song in songs:
+      batches.setdefault(song.playlist if song.playlist in self.sources else None, []).append((song, DatabaseHandler.getSong(song.id)))
+    count = 0
+    for playlist, batch in batches.items():
+      pipeline = self.getPipeline(playlist)
+      items = [(song, songInfo, pipeline.key(songInfo)) for song, songInfo in batch]
+      if onlyChanged:
+        items = [item for item in items if item[0].ruleKey != (pipeline, item[2])]
+      results = pipeline.evaluateMany([songInfo for song, songInfo, key in items], processes, keys=[key for song, songInfo, key in items])
+      for (song, songInfo, key), updates in zip(items, results):
+        originalSettings = song.settings.copy()
+        song.defaults.resetAll()
+        song.defaults.update(updates)
+        song.ruleKey = (pipeline, key)
+        self.finishRules(song, originalSettings, True)
+      count += len(items)
+    return count
+
+  def songInfoChanged(self, songID):
+    """ Called by DatabaseHandler whenever a song's information changes. The song's rules are run again on the next refresh """
+    if songID in self.songsById:
+      with self.dirtyLock:
+        self.dirtySongs.add(songID)
+
+  def refresh(self):
+    """
+    Runs the rules again for songs whose information changed since the last time, queueing changes for any that moved
+    Only songs where a field the rules read has changed are actually re-evaluated
+    """
+    with self.dirtyLock:
+      dirty, self.dirtySongs = self.dirtySongs, set()
+    songs = [song for songID in dirty for song in self.songsById.get(songID, ())]
+    count = self.runRulesFor(songs, onlyChanged=True)
+    if count:
+      log.debug("Re-ran rules for {} of {} changed songs".format(count, len(songs)))
+
+  def rulesChanged(self, playlist=None):
+    """
+    Call after adding, removing or changing rules. Re-runs rules for only the songs they apply to and queues changes for any that moved
+    :param playlist: Id of the playlist whose rules changed, or None for the set's own rules, which apply to every song
+    """
+    if playlist is None:
+      self.pipelines.clear()
+      songs = self.songsExpected
+    else:
+      self.pipelines.pop(playlist, None)
+      songs = self.songsByPlaylist.get(playlist, [])
+    self.runRulesFor(songs)
+
+  def addRule(self, rule, playlist=None):
+    """ Adds a rule to the set, or to one of its playlists, and applies it """
+    (self.rules if playlist is None else self.sources[playlist].rules).append(rule)
+    self.rulesChanged(playlist)
+
+  def updatePlaylist(self, playlist, updates):
+    """
+    Changes settings of a playlist (a Playlist object), queueing changes for only its songs that move or get new tags
+    Rules don't read settings, so they don't need to run again
+    """
+    songs = [song for song in self.songsByPlaylist.get(playlist.id, []) if song.settings["filename"]]
+    originals = [song.settings.copy() for song in songs]
+    playlist.settings.update(updates)
+    for song, originalSettings in zip(songs, originals):
+      self.finishRules(song, originalSettings, True)
       
   def makeSong(self, id, playlist=None):
     """ 
@@ -140,39 +267,112 @@ class MusicSet:
       :param playlist: id of the playlist this song came from (or None)
       
       When complete, the song will be added to list of complete and an entry in changeSet will be made
+      If the set already has this song from this playlist, that song is updated and returned instead of making another
     """
-    songInfo = DatabaseHandler.getSong(id)
+    if not (playlist and playlist in self.sources):
+      playlist = None
+    existing = self.songsByOrganization.get((playlist or "")+"/"+id)
+    if existing is not None:
+      self.runRules(existing) # Its info in the database may have changed
+      self.indexPath(existing)
+      return existing
     song = Song(self)
     song.id = id
-    if playlist and playlist in self.sources:
+    if playlist:
       song.setPlaylist(self.sources[playlist])
     self.runRules(song)
-    self.songsExpected.append(song)
+    return self.addSong(song)
+
+  def addSong(self, song):
+    """
+    Adds a song to the songs we expect to have, unless one with the same organization is already there
+    Returns the song that is in the set, which is the one already there if there was one
+    """
+    key = song.getOrganization()
+    existing = self.songsByOrganization.get(key)
+    if existing is None:
+      self.songsByOrganization[key] = song
+      self.songsById.setdefault(song.id, []).append(song)
+      self.songsByPlaylist.setdefault(song.playlist, []).append(song)
+      self.songsExpected.append(song)
+    elif existing is not song:
+      log.debug("Song '{}' is already in the set, not adding it again".format(key))
+      song = existing
+    self.indexPath(song)
     return song
-    
-  def resolveChangeSet(self):
-    """ Function to apply all the changes in the changeSet. Expects all necessary songs have been downloaded already """
+
+  def removeSong(self, song):
+    """ Stops expecting a song, and frees its row. Its file is left where it is """
+    key = song.getOrganization()
+    if self.songsByOrganization.get(key) is not song:
+      return
+    del self.songsByOrganization[key]
+    self.songsById[song.id].remove(song)
+    if not self.songsById[song.id]:
+      del self.songsById[song.id]
+    self.songsByPlaylist[song.playlist].remove(song)
+    if self.songsByPath.get(song.indexedPath) is song:
+      del self.songsByPath[song.indexedPath]
+    self.songsExpected.remove(song)
+    with self.changeSetLock:
+      self.changeSet.pop(key, None)
+    song.release()
+
+  def indexPath(self, song):
+    """ Updates the path index for a song whose folder or filename may have changed """
+    if song.settings["filename"] is None or self.songsByOrganization.get(song.getOrganization()) is not song:
+      return
+    oldPath = song.indexedPath
+    newPath = os.path.join(song.settings["folder"], song.settings["filename"])
+    if oldPath != newPath:
+      if self.songsByPath.get(oldPath) is song:
+        del self.songsByPath[oldPath]
+      self.songsByPath[newPath] = song
+      song.indexedPath = newPath
+
+  def queueChange(self, origPath, song):
+    """
+    Adds a file operation to the changeSet. origPath is the file's current location relative to the set's directory, or None if it needs to be copied from the cache
+    If the song already has a change queued, the two are merged so the file is only touched once.
+      The original location of the first change is kept, since that is where the file actually is
+    """
+    with self.changeSetLock:
+      key = song.getOrganization()
+      if key in self.changeSet:
+        origPath = self.changeSet[key][0]
+      self.changeSet[key] = (origPath, song)
+    
+  def planChangeSet(self):
+    """ Empties the changeSet into a list of FileHandler.FileOperation, using each song's settings as they are right now """
+    plan = []
     with self.changeSetLock:
-      for firstObj, song in self.changeSet:
-        if firstObj is None: # If the file doesn't exist in it's proper destination
-          FileHandler.copySong(song.id, song.settings["folder"], song.settings["filename"],
-            title=song.settings["title"],
-            artist=song.settings["artist"],
-            album=song.settings["album"],
-            organization=(song.playlist or "")+"/"+song.id
-          )
-          self.songsExpected.append(song) # Add to the list of songs we expect to have
-        else: # If the file already exists
-          dest = os.path.join(song.settings["folder"], song.settings["filename"])
-          if dest != firstObj:
-            FileHandler.moveSong(firstObj, dest)
-          FileHandler.changeTags(dest, {
-            "title": song.settings["title"],
-            "artist": song.settings["artist"],
-            "album": song.settings["album"],
-            "organization": (song.playlist or "")+"/"+song.id
-          })
+      for firstObj, song in self.changeSet.values():
+        tags = {
+          "title": song.settings["title"],
+          "artist": song.settings["artist"],
+          "album": song.settings["album"],
+          "organization": song.getOrganization(),
+        }
+        plan.append(FileHandler.FileOperation(song.id, song.settings["folder"], song.settings["filename"], tags, source=firstObj, root=self.directory or ""))
+        if firstObj is None:
+          self.addSong(song) # Add to the list of songs we expect to have
       self.changeSet.clear()
+    return plan
+
+  def resolveChangeSet(self, progressFunction=None):
+    """
+    Function to apply all the changes in the changeSet. Expects all necessary songs have been downloaded already
+    The lock is only held while the changes are taken out of the changeSet, so new changes can be queued while files are copied
+    :param progressFunction: If given, called after each file operation with (operations done, total operations, operation)
+    """
+    plan = self.planChangeSet()
+    if plan:
+      log.debug("Resolving {} file changes".format(len(plan)))
+      before = FileHandler.getTagStats()
+      FileHandler.runOperations(plan, progressFunction)
+      after = FileHandler.getTagStats() # Other sets may be resolving at the same time, so this is only exact when they aren't
+      log.info("Rewrote tags of {} existing files, skipped {} that were unchanged".format(
+        after["written"] - before["written"], after["skipped"] - before["skipped"]))
   
   def getDownloadCallback(self, id, playlist=None):
     """ Makes a new callback function to be used as the "complete function" for downloader
@@ -181,7 +381,7 @@ class MusicSet:
     def callback(songID, success):
       if success:
         with self.changeSetLock:
-          self.changeSet.append((None, self.makeSong(id, playlist)))
+          self.queueChange(None, self.makeSong(id, playlist))
         self.resolveChangeSet()
       else:
         log.error("Song failed to download: "+songID)
@@ -189,29 +389,44 @@ class MusicSet:
     return callback
     
   def songExists(self, songID, playlistID):
-    for songObj in self.songsExpected:
-      if songObj.id == songID and songObj.playlist == playlistID:
-        return songObj
-    return False
+    return self.songsByOrganization.get((playlistID or "")+"/"+songID, False)
 
-  def getDownloadSet(self):
+  def getDownloadSet(self, force_refresh=False):
+    """
+    Finds all songs in our playlists that need to be downloaded
+    :param force_refresh: If true, playlist information is always fetched from youtube rather than the cache
+    """
     # NOTE: THIS HAS THE SIDE EFFECT OF MOVING ALL SONGS THAT ARE DOWNLOADED BUT NOT IN EXPECTED SET
-    songsHash = {}
-    for song in self.songsExpected:
-      songsHash[song.getOrganization()] = True
     toDownload = []
 
-    for source in self.sources:
-      songsInPlaylist = DatabaseHandler.addSongFromDict(DownloadHandler.handler.getInfo(source, playlist=True))
+    # Ask about every playlist at once. getInfo still waits on the rate limiter, so this only overlaps the waiting on youtube
+    handler = DownloadHandler.getHandler()
+    futures = [(source, handler.metadataExecutor.submit(handler.getInfo, source, playlist=True, force_refresh=force_refresh)) for source in self.sources]
+
+    for source, future in futures:
+      info = future.result()
+      if isinstance(info, str):
+        log.error("Could not get playlist '{}': {}".format(source, info))
+        continue
+      fingerprint = DownloadHandler.InfoCache.fingerprint(info)
+      if fingerprint == self.sources[source].fingerprint: # Playlist hasn't changed since we last synced, so the database already has its songs
+        songsInPlaylist = [entry["id"] if DatabaseHandler.hasSong(entry["id"]) else DatabaseHandler.addSongFromDict(entry) for entry in info["entries"]]
+      else:
+        songsInPlaylist = DatabaseHandler.addSongFromDict(info)
+        self.sources[source].fingerprint = fingerprint
       for songID in songsInPlaylist:
         if songID not in self.ignored:
           if DatabaseHandler.isDownloaded(songID):
             if not self.songExists(songID, source):
-              self.changeSet.append((None, self.makeSong(songID, source)))
+              self.queueChange(None, self.makeSong(songID, source))
+          elif DatabaseHandler.isUnavailable(songID): # Removed, private, blocked... no point asking again yet
+            log.debug("Skipping unavailable song '{}'".format(songID))
           else:
             toDownload.append((songID, source))
-      if self.changeSet:
-        self.resolveChangeSet()
+    self.refresh() # Songs whose titles changed on youtube may need renaming
+    if self.changeSet: # All file changes for every playlist are done together
+      self.resolveChangeSet()
+    handler.infoCache.save()
 
     return toDownload
 
@@ -228,6 +443,7 @@ class Playlist:
     self.id = None
     self.title = None
     self.folder = None
+    self.fingerprint = None # Fingerprint of the playlist's contents when it was last synced, see DownloadHandler.InfoCache
     self.rules = []
 
     if init: self.initialize(init) # Removes an extra line if we are initializing and setting
@@ -235,11 +451,16 @@ class Playlist:
   def initialize(self, loadDict):
     self.id = loadDict["id"]
     self.title = loadDict["title"]
+    self.fingerprint = loadDict.get("fingerprint")
     self.setFolder(loadDict["folder"])
     
   def setFolder(self, folder):
     self.folder = folder
-    self.settings["folder"] = folder
+    self.updateSettings({"folder": folder})
+
+  def updateSettings(self, updates):
+    """ Changes settings for every song in the playlist, moving or retagging the songs affected. See MusicSet.updatePlaylist """
+    self.musicSet.updatePlaylist(self, updates)
 
 # Settings that are made per-song, and which the defaults can be modified at the music-set level
 songSettings = Settings.SettingsDict({
@@ -251,23 +472,282 @@ songSettings = Settings.SettingsDict({
   "album": None,
 })
 
+_unset = object() # Marks a field that a row has no value for in a layer of its settings
+
+class SongTable:
+  """
+  Stores every song of a MusicSet in columns, one row per song, so a song doesn't need objects and dicts of its own
+  Song objects are small views onto a row, and their settings are views onto the row's layers of settings:
+    overrides: Settings the user changed. Most songs have none, so only rows that do have a dict of them
+    values: What the rules decided, a column for each field
+    group: The playlist id and the settings the song falls back on, which are its playlist's or the set's
+  Playlists and repeated values (folders, artists, albums) are only stored once and shared between rows
+  """
+
+  sharedFields = frozenset(("folder", "artist", "album")) # Fields many songs often have the same value for
+
+  def __init__(self, fallback):
+    """ :param fallback: The SettingsDict songs fall back on until given a playlist, the set's song settings """
+    self.lock = threading.RLock() # Held while adding rows or columns
+    self.fallback = fallback
+    self.groupList = [] # (playlist id, SettingsDict to fall back on)
+    self.groupCodes = {} # (playlist id, id of SettingsDict) to position in groupList
+    self.strings = {} # Values of sharedFields, so equal strings are the same object
+    self.ids = []
+    self.groups = array("i") # Position in groupList of each row's group
+    self.values = {} # Field to a list of the value of every row, or _unset
+    self.overrides = {} # Row to dict of overridden settings, for rows that have any
+    self.indexedPaths = []
+    self.rulePipelines = []
+    self.ruleKeys = []
+    self.freeRows = [] # Rows given back by freeRow, used again before the table grows
+
+  def __len__(self):
+    return len(self.ids) - len(self.freeRows)
+
+  def addRow(self):
+    """ Adds an empty row and returns its number """
+    with self.lock:
+      if self.freeRows:
+        return self.freeRows.pop()
+      row = len(self.ids)
+      self.ids.append(None)
+      self.groups.append(self.group(None, self.fallback))
+      self.indexedPaths.append(None)
+      self.rulePipelines.append(None)
+      self.ruleKeys.append(None)
+      for column in self.values.values():
+        column.append(_unset)
+    return row
+
+  def freeRow(self, row):
+    """ Empties a row so addRow can give it to another song. Nothing may use the row's Song or settings views afterwards """
+    with self.lock:
+      self.ids[row] = None
+      self.groups[row] = self.group(None, self.fallback)
+      self.indexedPaths[row] = None
+      self.rulePipelines[row] = None
+      self.ruleKeys[row] = None
+      for column in self.values.values():
+        column[row] = _unset
+      self.overrides.pop(row, None)
+      self.freeRows.append(row)
+
+  def group(self, playlist, parent):
+    """ Returns the number of the group for a playlist id and the settings to fall back on, adding it if needed """
+    code = self.groupCodes.get((playlist, id(parent)))
+    if code is None:
+      with self.lock:
+        code = self.groupCodes.get((playlist, id(parent)))
+        if code is None:
+          code = self.groupCodes[(playlist, id(parent))] = len(self.groupList)
+          self.groupList.append((playlist, parent)) # Also keeps the settings alive, so their id isn't reused
+    return code
+
+  def getParent(self, row):
+    return self.groupList[self.groups[row]][1]
+
+  def getValues(self, row):
+    """ Returns a dict of just the settings the rules decided for a row """
+    values = {}
+    for field, column in self.values.items():
+      value = column[row]
+      if value is not _unset:
+        values[field] = value
+    return values
+
+  def setValue(self, row, field, value):
+    column = self.values.get(field)
+    if column is None:
+      with self.lock:
+        column = self.values.get(field)
+        if column is None:
+          column = self.values[field] = [_unset] * len(self.ids)
+    if field in self.sharedFields and type(value) is str:
+      value = self.strings.setdefault(value, value)
+    column[row] = value
+
+  def clearValue(self, row, field):
+    column = self.values.get(field)
+    if column is None or column[row] is _unset:
+      raise KeyError(field)
+    column[row] = _unset
+
+  def setOverride(self, row, field, value):
+    if field in self.sharedFields and type(value) is str:
+      value = self.strings.setdefault(value, value)
+    self.overrides.setdefault(row, {})[field] = value
+
+  def clearOverride(self, row, field):
+    overrides = self.overrides.get(row, {})
+    del overrides[field]
+    if not overrides:
+      self.overrides.pop(row, None)
+
+class SongSettings:
+  """
+  The settings of a song, a view onto its row of a SongTable that works like the SettingsDict it replaces
+  Each song has two layers: "settings" are what the user overrode, on top of "defaults", what the rules decided,
+    on top of the settings of its playlist or set
+  """
+
+  __slots__ = ("table", "row", "isOverrides")
+
+  def __init__(self, table, row, isOverrides):
+    self.table = table
+    self.row = row
+    self.isOverrides = isOverrides
+
+  def __getitem__(self, key):
+    table, row = self.table, self.row
+    if self.isOverrides:
+      overrides = table.overrides.get(row)
+      if overrides and key in overrides:
+        return overrides[key]
+    column = table.values.get(key)
+    if column is not None:
+      value = column[row]
+      if value is not _unset:
+        return value
+    return table.getParent(row)[key]
+
+  def __setitem__(self, key, value):
+    if self.isOverrides:
+      self.table.setOverride(self.row, key, value)
+    else:
+      self.table.setValue(self.row, key, value)
+
+  def __delitem__(self, key):
+    if self.isOverrides:
+      self.table.clearOverride(self.row, key)
+    else:
+      self.table.clearValue(self.row, key)
+
+  def __contains__(self, key):
+    try:
+      self[key]
+    except KeyError:
+      return False
+    return True
+
+  def __iter__(self):
+    return iter(self.copy())
+
+  def __len__(self):
+    return len(self.copy())
+
+  def __repr__(self):
+    return repr(self.copy())
+
+  def update(self, updateDict=None, **updates):
+    for key, value in (updates if updateDict is None else updateDict).items():
+      self[key] = value
+
+  def copy(self):
+    """ Creates a dict-copy of this object """
+    toRet = self.table.getParent(self.row).copy()
+    toRet.update(self.table.getValues(self.row))
+    if self.isOverrides:
+      toRet.update(self.table.overrides.get(self.row, ()))
+    return toRet
+
+  def getOverrides(self):
+    """ Returns a copy of just the settings in this layer """
+    if self.isOverrides:
+      return dict(self.table.overrides.get(self.row, ()))
+    return self.table.getValues(self.row)
+
+  def getDefault(self, key):
+    if self.isOverrides:
+      return SongSettings(self.table, self.row, False)[key]
+    return self.table.getParent(self.row)[key]
+
+  def isDefault(self, key):
+    """ Returns true if the key is in the defaults and not in this layer, false otherwise """
+    if key in self.getOverrides():
+      return False
+    try:
+      self.getDefault(key)
+    except KeyError:
+      return False
+    return True
+
+  # NOTE: Keys should always be cleared rather than set to the default value, as the default is global and could be changed.
+  def resetKey(self, key):
+    del self[key]
+
+  def resetAll(self):
+    for key in self.getOverrides():
+      del self[key]
+
 class Song:
   """
   A song contains information regarding how a song should be stored, including artist overrides
+  The song's information is kept in a row of a SongTable, so that very large sets don't need several objects per song
   """
+
+  __slots__ = ("table", "row")
   
-  def __init__(self, musicSet, init=None):
+  def __init__(self, musicSet, init=None, table=None):
     """
     musicSet: A MusicSet instance where this song gets its song settings from.
+    table: The SongTable to store the song in, by default the one for the set's expected songs
     """
-    self.id = None # ID of this song
-    self.playlist = None # ID of the playlist this song is associated with
-    
-    # So each song should have a default value which is assigned automatically, then allow for an override from the user as settings
-    self.defaults = musicSet.songSettings.createInstance()
-    self.settings = self.defaults.createInstance()
+    self.table = musicSet.songTable if table is None else table
+    self.row = self.table.addRow()
     
     if init: self.initialize(init)
+
+  def release(self):
+    """ Gives the song's row back to its table. For a song that is no longer kept anywhere, after which it can't be used """
+    self.table.freeRow(self.row)
+    self.row = None
+
+  # ID of this song
+  @property
+  def id(self):
+    return self.table.ids[self.row]
+
+  @id.setter
+  def id(self, value):
+    self.table.ids[self.row] = value
+
+  # ID of the playlist this song is associated with
+  @property
+  def playlist(self):
+    return self.table.groupList[self.table.groups[self.row]][0]
+
+  @playlist.setter
+  def playlist(self, value):
+    self.table.groups[self.row] = self.table.group(value, self.table.getParent(self.row))
+
+  # Path this song is filed under in its MusicSet's path index
+  @property
+  def indexedPath(self):
+    return self.table.indexedPaths[self.row]
+
+  @indexedPath.setter
+  def indexedPath(self, value):
+    self.table.indexedPaths[self.row] = value
+
+  # The pipeline and song information the rules were last run with, see MusicSet.runRulesFor
+  @property
+  def ruleKey(self):
+    pipeline = self.table.rulePipelines[self.row]
+    return None if pipeline is None else (pipeline, self.table.ruleKeys[self.row])
+
+  @ruleKey.setter
+  def ruleKey(self, value):
+    self.table.rulePipelines[self.row], self.table.ruleKeys[self.row] = value or (None, None)
+
+  # So each song should have a default value which is assigned automatically, then allow for an override from the user as settings
+  @property
+  def defaults(self):
+    return SongSettings(self.table, self.row, False)
+
+  @property
+  def settings(self):
+    return SongSettings(self.table, self.row, True)
     
   def initialize(self, fileDict):
     """
@@ -294,11 +774,12 @@ class Song:
     return (self.playlist or "") + "/" + self.id
   
   def setPlaylist(self, playlist): # Expects playlist object, not id
-    self.playlist = playlist.id
-    self.setDefaultDict(playlist.settings)
+    self.table.groups[self.row] = self.table.group(playlist.id, playlist.settings)
     
   def setDefaultDict(self, defaultDict):
-    self.defaults.setDefaultDict(defaultDict)
+    if not isinstance(defaultDict, dict):
+      raise TypeError("SettingsDict default dict must be dict subclass")
+    self.table.groups[self.row] = self.table.group(self.playlist, defaultDict)
 
 def RuleRegister(name): #Helper method to add registration so we can load rules from file
   def inner(otherClass):
@@ -318,6 +799,8 @@ class Rule:
   def getRule(name):
     return _rulesTypes[name]
 
+  fields = None # The song information this rule reads, or None if it may read any of it. Used to tell when results can be reused
+
   def __init__(self):
     self._name = None
     self._info = {} # A json-serializable object with settings for the rule
@@ -352,6 +835,12 @@ class Rule:
 
 @RuleRegister("ArtistTitle")
 class ArtistTitleRule(Rule):
+  fields = ("title", "songTitle", "songArtist", "songAlbum")
+  artistPattern = re.compile("(.+?) ?[|-]")
+  titlePattern = re.compile("[|-] ?(.+)")
+  # "lyrics", "official lyrics", "official video", "music video", "official music video", "with lyrics", etc. possibly in parenthesis
+  extrasPattern = re.compile(r" ?\(?(?:official |with )?(?:music )?(?:lyrics|video|audio|lyric video)\)?", re.IGNORECASE)
+
   def __init__(self, useYoutubeMetadata):
     super().__init__()
     self._info["meta"] = useYoutubeMetadata
@@ -359,20 +848,19 @@ class ArtistTitleRule(Rule):
   def function(self, info):
     meta = self._info["meta"]
   
-    artist = (info["songArtist"] if meta else None) or re.match("(.+?) ?[|-]", info["title"])
+    artist = (info["songArtist"] if meta else None) or self.artistPattern.match(info["title"])
     try: artist = artist.group(1)
     except AttributeError: pass
     # Note: Artist could still be "None" here
     
-    title = (info["songTitle"] if meta else None) or re.search("[|-] ?(.+)", info["title"])
+    title = (info["songTitle"] if meta else None) or self.titlePattern.search(info["title"])
     try: title = title.group(1)
     except AttributeError: pass
     
     if not artist or not title:
       title = info["title"]
 
-    # Get rid of "lyrics", "official lyrics", "official video", "music video", "official music video", "with lyrics", etc. possibly in parenthesis
-    title = re.sub(r" ?\(?(?:official |with )?(?:music )?(?:lyrics|video|audio|lyric video)\)?", "", title, flags=re.IGNORECASE)
+    title = self.extrasPattern.sub("", title)
     title = title.replace('"',"") # Remove quotes
     
     toRet = {}
@@ -383,4 +871,111 @@ class ArtistTitleRule(Rule):
       toRet.update({"filename": title})
     else:
       toRet.update({"filename": "{} - {}".format(artist, title), "artist": artist})
-    return toRet
\ No newline at end of file
+    return toRet
+
+
+_unsafeCharacters = re.compile(r'[/\:<>?*"|]') # Not allowed in file and folder names
+
+def _evaluateRules(rules, songInfos):
+  """ Evaluates rules for many songs in another process, see RulePipeline.evaluateMany """
+  pipeline = RulePipeline(rules)
+  return [pipeline.evaluate(songInfo) for songInfo in songInfos]
+
+class RulePipeline:
+  """
+  A list of rules run one after another, as one function of a song's information to the updates for its defaults
+  Since rules only look at the song's information, results are remembered for each distinct song information,
+    so songs that haven't changed don't run the rules again. Pipelines are shared between every set of rules configured the same, see forRules
+  """
+  cacheSize = 100000 # Results remembered by each pipeline, least recently used are dropped first
+  sharedPipelines = 16 # Pipelines kept for sharing, least recently used are dropped first. Sets still hold on to the ones they use
+  _pipelines = OrderedDict() # Signature of a list of rules to its pipeline
+  _pipelinesLock = threading.Lock()
+
+  def __init__(self, rules):
+    self.rules = list(rules)
+    self.lock = threading.Lock()
+    self.results = OrderedDict() # Key of song information to dict of updates
+    # If every rule says what it reads, results only depend on those fields
+    if all(rule.fields is not None for rule in self.rules):
+      self.fields = tuple(sorted({field for rule in self.rules for field in rule.fields}))
+    else:
+      self.fields = None
+
+  @classmethod
+  def forRules(cls, rules):
+    """ Returns the pipeline for a list of rules, reusing one made before if the rules and their settings are the same """
+    signature = tuple((type(rule), json.dumps(rule.save(), sort_keys=True)) for rule in rules)
+    with cls._pipelinesLock:
+      pipeline = cls._pipelines.get(signature)
+      if pipeline is None:
+        pipeline = cls._pipelines[signature] = cls(rules)
+        while len(cls._pipelines) > cls.sharedPipelines:
+          cls._pipelines.popitem(last=False)
+      else:
+        cls._pipelines.move_to_end(signature)
+      return pipeline
+
+  def key(self, songInfo):
+    if self.fields is not None:
+      return tuple(songInfo.get(field) for field in self.fields)
+    return json.dumps(songInfo, sort_keys=True, default=str)
+
+  def run(self, songInfo):
+    """ Runs every rule without looking at remembered results """
+    updates = {}
+    for rule in self.rules:
+      songUpdates = rule.function(songInfo)
+      if songUpdates:
+        updates.update(songUpdates)
+    return updates
+
+  def remember(self, key, updates):
+    with self.lock:
+      self.results[key] = updates
+      while len(self.results) > self.cacheSize:
+        self.results.popitem(last=False)
+
+  def lookup(self, key):
+    with self.lock:
+      updates = self.results.get(key)
+      if updates is not None:
+        self.results.move_to_end(key)
+      return updates
+
+  def evaluate(self, songInfo):
+    """ Returns the dict of updates the rules make for this song information. The dict is shared, so must not be modified """
+    key = self.key(songInfo)
+    updates = self.lookup(key)
+    if updates is None:
+      updates = self.run(songInfo)
+      self.remember(key, updates)
+    return updates
+
+  def evaluateMany(self, songInfos, processes=None, minimumPerProcess=2000, keys=None):
+    """
+    Like evaluate for a list of song information, returning a list of updates in the same order
+    :param processes: If given and there are at least minimumPerProcess new songs per process, new songs are evaluated in a process pool
+    :param keys: The key of each song information, if already known
+    """
+    if keys is None:
+      keys = [self.key(songInfo) for songInfo in songInfos]
+    with self.lock:
+      results = [self.results.get(key) for key in keys]
+    missing = {} # Key to song information, for each distinct song information not seen before
+    for key, songInfo, updates in zip(keys, songInfos, results):
+      if updates is None and key not in missing:
+        missing[key] = songInfo
+
+    if processes and len(missing) >= processes * minimumPerProcess:
+      infos = list(missing.values())
+      chunkSize = -(-len(infos) // (processes * 4))
+      chunks = [infos[i:i+chunkSize] for i in range(0, len(infos), chunkSize)]
+      with ProcessPoolExecutor(max_workers=processes) as pool:
+        computed = [updates for chunk in pool.map(_evaluateRules, [self.rules]*len(chunks), chunks) for updates in chunk]
+    else:
+      computed = [self.run(songInfo) for songInfo in missing.values()]
+    found = dict(zip(missing, computed))
+    for key, updates in found.items():
+      self.remember(key, updates)
+    return [updates if updates is not None else found[key] for key, updates in zip(keys, results)]
@@ -15,7 +15,17 @@ def checkUpdates():
   return True
 
 
+#Starts the slow parts of the program without waiting on them. Everything else (the download processor, images)
+#  is only created the first time it is used, so nothing here should block the window from opening
+def bootstrap():
+  import DatabaseHandler, DownloadHandler, threading
+  DatabaseHandler.initialize(background=DatabaseHandler.settings["backgroundInitialize"])
+  #Downloads that were cut off last time are picked up again once the download processor is ready
+  threading.Thread(target=lambda: DownloadHandler.getHandler().resumeJobs(), name="ResumeJobs", daemon=True).start()
+
+
 def main():  
+  bootstrap()
   import mainDisplay
   mainDisplay.main("Title")
   
@@ -4,10 +4,18 @@ import tkinter as tk
 from tkinter import ttk
 from log import log, consoleQueue, EmptyException
 from os.path import join
-from PIL import Image, ImageTk
 
 import msgBox
 
+#Images are opened on first use, so that importing PIL doesn't slow down opening the window
+_images = {}
+
+def loadImage(filename):
+  from PIL import Image
+  if filename not in _images:
+    _images[filename] = Image.open(filename)
+  return _images[filename]
+
 
 class EventReceiver():
   _tkRoot = None
@@ -134,11 +142,12 @@ class Background():
     parent.bind("<Configure>", self.receiveConfigure)
 
   def updateImage(self, filename=None):
+    from PIL import Image, ImageTk
     if not self.img: #If this is the first time we load image
-      self.img = Image.open(self.filename)
+      self.img = loadImage(self.filename)
     elif filename and filename != self.filename:
       self.filename = filename
-      self.img = Image.open(filename)
+      self.img = loadImage(filename)
     #Find the smallest size so that the image doesn't overflow the
     multiplier = max(*[self.size[i] / self.img.size[i] for i in range(2)])
     # log.info(self.img.size)
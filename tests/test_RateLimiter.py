@@ -0,0 +1,92 @@
+# Tests for DownloadHandler.RateLimiter, run with "python -m unittest discover tests" from the repository folder
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import logging
+logging.disable(logging.WARNING)
+
+from DownloadHandler import RateLimiter
+
+class FakeClock:
+  """ A clock that only moves when told to. If "advance" is set, sleeping moves it on, as if the caller had really waited """
+
+  def __init__(self, advance=True):
+    self.now = 0.0
+    self.advance = advance
+    self.sleeps = []
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    if self.advance:
+      self.now += seconds
+
+def makeLimiter(rate, burst=1, advance=True, **kwargs):
+  clock = FakeClock(advance)
+  return RateLimiter(rate, burst, clock=clock, sleep=clock.sleep, **kwargs), clock
+
+class TestRateLimiter(unittest.TestCase):
+
+  def test_burst(self):
+    limiter, clock = makeLimiter(10, 5)
+    self.assertEqual([limiter.acquire() for i in range(5)], [0.0] * 5)
+    self.assertAlmostEqual(limiter.acquire(), 0.1)
+    self.assertEqual(len(clock.sleeps), 1)
+
+  def test_burst_refills_after_idle(self):
+    limiter, clock = makeLimiter(10, 5)
+    for i in range(5):
+      limiter.acquire()
+    clock.now += 100 # Idle for much longer than it takes to refill, but only "burst" calls are saved up
+    self.assertEqual([limiter.acquire() for i in range(5)], [0.0] * 5)
+    self.assertAlmostEqual(limiter.acquire(), 0.1)
+
+  def test_steady_rate(self):
+    limiter, clock = makeLimiter(4, 1)
+    waits = [limiter.acquire() for i in range(20)]
+    self.assertEqual(waits[0], 0.0)
+    for wait in waits[1:]:
+      self.assertAlmostEqual(wait, 0.25)
+    self.assertAlmostEqual(clock.now, 19 * 0.25)
+
+  def test_reserve_and_sleep_order(self):
+    # Callers arriving together each reserve the next token, so each sleeps one interval longer than the one before it
+    limiter, clock = makeLimiter(2, 1, advance=False)
+    waits = [limiter.acquire() for i in range(4)]
+    for wait, expected in zip(waits, (0.0, 0.5, 1.0, 1.5)):
+      self.assertAlmostEqual(wait, expected)
+    self.assertEqual(len(clock.sleeps), 3)
+
+  def test_unlimited(self):
+    limiter, clock = makeLimiter(0, 1)
+    self.assertEqual([limiter.acquire() for i in range(100)], [0.0] * 100)
+    self.assertEqual(clock.sleeps, [])
+
+  def test_backoff_grows_and_is_capped(self):
+    limiter, clock = makeLimiter(1, 1, baseBackoff=1.0, maxBackoff=8.0)
+    penalties = []
+    for i in range(6):
+      limiter.backoff()
+      penalties.append(limiter.penalty)
+    self.assertEqual(penalties, [1.0, 2.0, 4.0, 8.0, 8.0, 8.0])
+
+  def test_backoff_delays_next_call(self):
+    limiter, clock = makeLimiter(1, 1, baseBackoff=3.0)
+    limiter.backoff() # Uses up the saved token, then pushes the next one back by the penalty
+    self.assertAlmostEqual(limiter.acquire(), 4.0)
+    self.assertAlmostEqual(limiter.acquire(), 1.0) # Then back to the normal rate
+
+  def test_succeed_resets_backoff(self):
+    limiter, clock = makeLimiter(1, 1, baseBackoff=1.0)
+    limiter.backoff()
+    limiter.backoff()
+    self.assertEqual(limiter.penalty, 2.0)
+    limiter.succeed()
+    self.assertEqual(limiter.penalty, 0.0)
+    limiter.backoff()
+    self.assertEqual(limiter.penalty, 1.0)
+
+if __name__ == "__main__":
+  unittest.main()